@@ -0,0 +1,202 @@
+#!/usr/bin/python3
+
+import array
+import json
+import mmap
+import pathlib
+import struct
+import sys
+import zlib
+
+from PIL import Image
+
+from layout import Dimensions, Plan, plan_pages
+from symbols import Symbol, create_symbols
+
+# A pattern file is written front to back in one go:
+#
+# magic
+# rows:     every row of palette indices, deflate compressed on its own,
+#           one byte per stitch for up to 256 colors and two otherwise
+# metadata: json with the size, colors, symbols, stitch counts and page plan
+# offsets:  uint64 start of every row
+# trailer:  uint64 start and length of the metadata, start of the offsets, magic
+magic = b"XSTITCH\x01"
+trailer_format = struct.Struct("<QQQ8s")
+
+class PatternWriter:
+    """Writes a pattern a row at a time to a path or a binary file
+
+    colors are in index order, symbols maps their rgb to a Symbol and
+    metadata is stored along with them.
+    """
+    def __init__(self, output, width, colors, symbols, **metadata):
+        self.close_file = isinstance(output, (str, pathlib.Path))
+        self.file = open(str(output), "wb") if self.close_file else output
+        self.width = width
+        self.colors = list(colors)
+        self.symbols = symbols
+        self.metadata = metadata
+        self.typecode = "B" if len(self.colors) <= 256 else "H"
+        self.counts = [0] * len(self.colors)
+        self.offsets = []
+        self.position = 0
+        self.write(magic)
+
+    def write(self, data):
+        self.file.write(data)
+        self.position += len(data)
+
+    def write_row(self, indices):
+        row = array.array(self.typecode, indices)
+        if len(row) != self.width:
+            raise ValueError("row of {} stitches in a pattern {} wide".format(len(row), self.width))
+        for index in row:
+            self.counts[index] += 1
+        if row.itemsize > 1 and sys.byteorder != "little":
+            row.byteswap()
+        self.offsets.append(self.position)
+        self.write(zlib.compress(row.tobytes()))
+
+    def close(self):
+        metadata = dict(self.metadata)
+        metadata.update(version=1,
+                        width=self.width,
+                        height=len(self.offsets),
+                        index_size=array.array(self.typecode).itemsize,
+                        colors=[color_entry(color, self.symbols[color.rgb()]) for color in self.colors],
+                        counts=self.counts)
+        data = json.dumps(metadata).encode("utf-8")
+        start = self.position
+        self.write(data)
+        offsets = self.position
+        self.write(struct.pack("<{}Q".format(len(self.offsets)), *self.offsets))
+        self.write(trailer_format.pack(start, len(data), offsets, magic))
+        if self.close_file:
+            self.file.close()
+        else:
+            self.file.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exception):
+        self.close()
+
+def color_entry(color, symbol):
+    entry = {"name": color.name,
+             "description": color.description,
+             "hex": color.hex,
+             "rgb": list(color.rgb()),
+             "symbol": symbol.index,
+             "symbol_name": symbol.name}
+    threads = getattr(color, "threads", None)
+    if threads:
+        entry["threads"] = [{"name": thread.name, "description": thread.description,
+                             "hex": thread.hex, "rgb": list(thread.rgb())}
+                            for thread in threads]
+    return entry
+
+def write(output, image, colors, args):
+    """Writes a converted image as a pattern, with the page plan of args"""
+    image = image.convert("RGB")
+    unique = dict()
+    for color in sorted(colors, key=lambda c: c.hsv()):
+        unique.setdefault(color.rgb(), color)
+    index = {rgb: i for i, rgb in enumerate(unique)}
+    plan = plan_pages(args, image.size)
+    settings = {"page": args.page, "grid": args.grid, "margin": args.margin, "overlap": args.overlap}
+    pixels = list(image.getdata())
+    with PatternWriter(output, image.width, unique.values(), create_symbols(unique.values()),
+                       settings=settings, plan=plan_entry(plan)) as writer:
+        for y in range(image.height):
+            writer.write_row(index[pixel] for pixel in pixels[y * image.width:(y + 1) * image.width])
+
+def plan_entry(plan):
+    return {"page": plan.page.name,
+            "width": plan.page.width,
+            "height": plan.page.height,
+            "orientation": plan.orientation,
+            "capacity": plan.capacity,
+            "columns": plan.columns,
+            "rows": plan.rows}
+
+class Pattern:
+    """A pattern file, memory mapped when given a path
+
+    Rows are only decompressed when asked for, so any page or part of the
+    pattern can be read without going through the rest.
+    """
+    def __init__(self, source):
+        if isinstance(source, (str, pathlib.Path)):
+            with open(str(source), "rb") as file:
+                self.data = memoryview(mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ))
+        else:
+            self.data = memoryview(source)
+        if bytes(self.data[:len(magic)]) != magic:
+            raise ValueError("not a pattern file")
+        start, length, offsets, end = trailer_format.unpack_from(self.data, len(self.data) - trailer_format.size)
+        if end != magic:
+            raise ValueError("truncated pattern file")
+        self.metadata = json.loads(bytes(self.data[start:start + length]).decode("utf-8"))
+        self.width = self.metadata["width"]
+        self.height = self.metadata["height"]
+        self.offsets = list(struct.unpack_from("<{}Q".format(self.height), self.data, offsets)) + [start]
+        self.typecode = "B" if self.metadata["index_size"] == 1 else "H"
+        self.entries = self.metadata["colors"]
+        self.counts = self.metadata["counts"]
+        self.rgbs = [tuple(entry["rgb"]) for entry in self.entries]
+        plan = self.metadata["plan"]
+        self.plan = Plan(Dimensions(plan["page"], plan["width"], plan["height"]), tuple(plan["capacity"]),
+                         [tuple(span) for span in plan["columns"]], [tuple(span) for span in plan["rows"]])
+
+    def row(self, y):
+        row = array.array(self.typecode, zlib.decompress(self.data[self.offsets[y]:self.offsets[y + 1]]))
+        if row.itemsize > 1 and sys.byteorder != "little":
+            row.byteswap()
+        return row
+
+    def indices(self, left=0, top=0, right=None, bottom=None):
+        """Rows of palette indices of a part of the pattern"""
+        right = self.width if right is None else right
+        bottom = self.height if bottom is None else bottom
+        return [self.row(y)[left:right] for y in range(top, bottom)]
+
+    def image(self, left=0, top=0, right=None, bottom=None):
+        """The pattern, or a part of it, as an rgb image with one pixel per stitch"""
+        rows = self.indices(left, top, right, bottom)
+        width = len(rows[0]) if rows else 0
+        result = Image.new("RGB", (width, len(rows)))
+        result.putdata([self.rgbs[index] for row in rows for index in row])
+        return result
+
+    def page(self, number):
+        """The stitches of one page of the stored plan as an image"""
+        for tile in self.plan.tiles():
+            if tile.number == number:
+                return self.image(tile.left, tile.top, tile.right, tile.bottom)
+        raise IndexError("no page {}".format(number))
+
+    def symbols(self):
+        return {rgb: Symbol(entry["symbol"]) for rgb, entry in zip(self.rgbs, self.entries)}
+
+    def colors(self):
+        """The colors of the pattern as xstitch colors, blends included"""
+        import xstitch
+        def color(entry):
+            return xstitch.Color(*entry["rgb"], entry["name"], entry["description"], entry["hex"])
+        result = []
+        for entry in self.entries:
+            if "threads" in entry:
+                result.append(xstitch.Blend(*(color(thread) for thread in entry["threads"])))
+            else:
+                result.append(color(entry))
+        return result
+
+    def report(self, args=None):
+        """A report.Report of the pattern, by default with the stored settings"""
+        import report
+        import xstitch
+        if args is None:
+            args = xstitch.default_arguments(**self.metadata["settings"])
+        return report.Report(args, self.image(), self.colors(), self.symbols())
@@ -0,0 +1,116 @@
+#!/usr/bin/python3
+
+import contextlib
+import io
+import os
+import random
+import sys
+import tempfile
+from PIL import Image
+
+import xstitch
+import export
+
+def random_colors(count):
+    rgbs = set()
+    while len(rgbs) < count:
+        rgbs.add(tuple(random.randint(0, 255) for _ in range(3)))
+    return [xstitch.Color(*rgb, str(i), "Color {}".format(i), "{:02X}{:02X}{:02X}".format(*rgb))
+            for i, rgb in enumerate(sorted(rgbs))]
+
+def pattern_image(size, colors):
+    image = Image.new("RGB", size)
+    image.putdata([random.choice(colors).rgb() for _ in range(size[0] * size[1])])
+    return image
+
+def round_trip(image, colors, args):
+    output = io.BytesIO()
+    with contextlib.redirect_stdout(io.StringIO()):
+        export.write(output, image, colors, args)
+    return export.Pattern(output.getvalue())
+
+def round_trip_test():
+    random.seed(11)
+    result = True
+    def check(name, value, expected):
+        nonlocal result
+        if value != expected:
+            print("ERROR: {}: {} != {}".format(name, value if len(str(value)) < 200 else "...", expected if len(str(expected)) < 200 else "..."))
+            result = False
+    args = xstitch.default_arguments(page="A5", overlap=2)
+    # One byte per stitch, then two
+    for count, index_size in [(12, 1), (300, 2)]:
+        colors = random_colors(count)
+        image = pattern_image((170, 130), colors)
+        pattern = round_trip(image, colors, args)
+        check("index size", pattern.metadata["index_size"], index_size)
+        check("size", (pattern.width, pattern.height), image.size)
+        check("stitches", list(pattern.image().getdata()), list(image.getdata()))
+        check("row", [pattern.rgbs[i] for i in pattern.row(7)], [image.getpixel((x, 7)) for x in range(image.width)])
+        used = {rgb: n for n, rgb in image.getcolors(image.width * image.height)}
+        check("counts", {rgb: n for rgb, n in zip(pattern.rgbs, pattern.counts) if n}, used)
+        check("colors", sorted(pattern.rgbs), sorted(color.rgb() for color in colors))
+        check("names", sorted(color.name for color in pattern.colors()), sorted(color.name for color in colors))
+        symbols = pattern.symbols()
+        check("symbols", len(set(symbol.index for symbol in symbols.values())), len(colors))
+        plan = export.plan_pages(args, image.size)
+        check("plan", (pattern.plan.columns, pattern.plan.rows, pattern.plan.page.name), (plan.columns, plan.rows, plan.page.name))
+        for tile in plan.tiles():
+            check("page {}".format(tile.number), list(pattern.page(tile.number).getdata()),
+                  list(image.crop((tile.left, tile.top, tile.right, tile.bottom)).getdata()))
+    return result
+
+def blend_test():
+    black = xstitch.Color(0, 0, 0, "310", "Black", "000000")
+    white = xstitch.Color(255, 255, 255, "B5200", "Snow White", "FFFFFF")
+    grey = xstitch.Blend(black, white)
+    colors = [black, white, grey]
+    image = pattern_image((20, 20), colors)
+    pattern = round_trip(image, colors, xstitch.default_arguments())
+    blends = [color for color in pattern.colors() if isinstance(color, xstitch.Blend)]
+    if len(blends) != 1 or blends[0].rgb() != grey.rgb() or [t.name for t in blends[0].threads] != ["310", "B5200"]:
+        print("ERROR: blends {}".format(blends))
+        return False
+    return True
+
+def file_test():
+    colors = random_colors(5)
+    image = pattern_image((40, 30), colors)
+    args = xstitch.default_arguments()
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "pattern.xsp")
+        with contextlib.redirect_stdout(io.StringIO()):
+            export.write(path, image, colors, args)
+        with open(path, "rb") as file:
+            data = file.read()
+        pattern = export.Pattern(path)
+        if list(pattern.image(5, 6, 25, 16).getdata()) != list(image.crop((5, 6, 25, 16)).getdata()):
+            print("ERROR: part of the pattern differs")
+            return False
+        del pattern
+    for broken in [data[:-3], b"NOTAFILE" + data[8:]]:
+        try:
+            export.Pattern(broken)
+        except ValueError:
+            continue
+        print("ERROR: a broken file was read")
+        return False
+    return True
+
+
+def run_tests(*fs):
+    result = 0
+    for f in fs:
+        print("====", f.__name__, "====")
+        if not f():
+            result = 1
+            print(f.__name__, "failed")
+    sys.exit(result)
+
+def main():
+    run_tests(round_trip_test,
+              blend_test,
+              file_test)
+
+if __name__ == "__main__":
+    main()
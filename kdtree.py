@@ -1,44 +1,94 @@
 #!/usr/bin/python3
 
+import heapq
 import math
 import itertools
 
 class KDTree:
     class Node:
-        def __init__(self, pivot, left, right):
+        def __init__(self, pivot, left, right, key=None):
             self.pivot = pivot
             self.left = left
             self.right = right
+            self.key = key
 
         def __repr__(self):
             return "Node({})".format(str((self.pivot, self.left, self.right)))
 
-    def __init__(self, values, axises):
+    def __init__(self, values, axises, layout=None):
         values = list(values)
         self.axises = axises
         self.cache = dict()
+        self.found = dict()
         self.selected = set()
         self.all = []
+        self.i = 0
+        self.point = None
+        self.debug = False
+        if layout is not None:
+            self.root = self.from_layout(values, layout)
+            return
 
+        # Every axis is only evaluated once per value, the build sorts on the keys
         def recursive(values, depth):
             if len(values) == 0:
                 return None
-            axis = axises[depth % len(axises)]
-            values.sort(key=axis)
+            axis = depth % len(axises)
+            values.sort(key=lambda item: item[0][axis])
             median = len(values)//2
-            while median > 0 and axis(values[median]) == axis(values[median - 1]):
+            while median > 0 and values[median][0][axis] == values[median - 1][0][axis]:
                 # ensure median is at boundery
                 median -= 1
             # while median + 1 < len(values) and axis(values[median]) == axis(values[median + 1]):
             #     # ensure median is at boundery
             #     median += 1
-            return self.Node(values[median],
+            key, pivot = values[median]
+            return self.Node(pivot,
                              recursive(values[:median], depth + 1),
-                             recursive(values[median + 1:], depth + 1))
-        self.root = recursive(values, 0)
-        self.i = 0
-        self.point = None
-        self.debug = False
+                             recursive(values[median + 1:], depth + 1),
+                             key)
+        self.root = recursive([(self.key(value), value) for value in values], 0)
+
+    def key(self, value):
+        return tuple(axis(value) for axis in self.axises)
+
+    def from_layout(self, values, layout):
+        """Rebuilds the nodes from a flat layout as returned by layout()"""
+        def recursive(slot):
+            if slot < 0:
+                return None
+            pivot, left, right = layout[slot*3:slot*3 + 3]
+            value = values[pivot]
+            return self.Node(value, recursive(left), recursive(right), self.key(value))
+        if len(layout) == 0:
+            return None
+        return recursive(0)
+
+    def layout(self, index):
+        """Returns the nodes as (pivot, left, right) triples in preorder
+
+        The pivot is given by index(value), the children as positions in the
+        returned list, -1 when there is no child.
+        """
+        result = []
+        def recursive(node):
+            if node is None:
+                return -1
+            slot = len(result)
+            result.append(None)
+            left = recursive(node.left)
+            right = recursive(node.right)
+            result[slot] = (index(node.pivot), left, right)
+            return slot
+        recursive(self.root)
+        return result
+
+    def copy(self):
+        """Returns a tree sharing the nodes and batch matches of this one, with an empty selection"""
+        result = KDTree([], self.axises)
+        result.root = self.root
+        result.found = dict(self.found)
+        return result
 
     def nearest_neighbour(self, point):
         self.i += 1
@@ -99,6 +149,81 @@ class KDTree:
         self.all.append(result)
         return result
 
+    def nearest_neighbours(self, points):
+        """Nearest neighbour of every point, searching each distinct point once
+
+        Found neighbours are kept, later calls only search new points.
+        """
+        dimensions = len(self.axises)
+        def search(target):
+            best = None
+            best_distance = math.inf
+            stack = [(self.root, 0, 0)]
+            while stack:
+                node, depth, bound = stack.pop()
+                if node is None or bound >= best_distance:
+                    continue
+                distance = 0
+                for a, b in zip(target, node.key):
+                    distance += (a - b) * (a - b)
+                if distance < best_distance:
+                    best = node.pivot
+                    best_distance = distance
+                axis = depth % dimensions
+                difference = target[axis] - node.key[axis]
+                if difference < 0:
+                    stack.append((node.right, depth + 1, difference * difference))
+                    stack.append((node.left, depth + 1, 0))
+                else:
+                    stack.append((node.left, depth + 1, difference * difference))
+                    stack.append((node.right, depth + 1, 0))
+            return best
+
+        found = self.found
+        result = []
+        for point in points:
+            key = self.key(point)
+            match = found.get(key)
+            if match is None:
+                match = search(key)
+                assert match is not None
+                found[key] = match
+            # Also for matches found before, selected is what this tree gave
+            self.selected.add(match)
+            self.all.append(match)
+            result.append(match)
+        return result
+
+    def nearest_to(self, target, count):
+        """Returns the count values nearest to target, a key as given by key()
+
+        The result is a list of (squared distance, value), nearest first.
+        """
+        dimensions = len(self.axises)
+        found = []
+        tiebreak = itertools.count()
+        stack = [(self.root, 0, 0)]
+        while stack:
+            node, depth, bound = stack.pop()
+            if node is None or (len(found) == count and bound >= -found[0][0]):
+                continue
+            distance = 0
+            for a, b in zip(target, node.key):
+                distance += (a - b) * (a - b)
+            if len(found) < count:
+                heapq.heappush(found, (-distance, next(tiebreak), node.pivot))
+            elif distance < -found[0][0]:
+                heapq.heapreplace(found, (-distance, next(tiebreak), node.pivot))
+            axis = depth % dimensions
+            difference = target[axis] - node.key[axis]
+            if difference < 0:
+                stack.append((node.right, depth + 1, difference * difference))
+                stack.append((node.left, depth + 1, 0))
+            else:
+                stack.append((node.left, depth + 1, difference * difference))
+                stack.append((node.right, depth + 1, 0))
+        return [(-distance, value) for distance, _, value in sorted(found, reverse=True)]
+
     def distance(self, pointa, pointb):
         return math.sqrt(sum((axis(pointa) - axis(pointb))** 2 for axis in self.axises))
 
@@ -137,3 +262,97 @@ class NaiveNeighbour:
         self.cache[point] = result
         self.selected.add(result)
         return result
+    def in_order(self):
+        return iter(self.values)
+    def copy(self):
+        return NaiveNeighbour(self.values, self.axises)
+    def nearest_neighbours(self, points):
+        found = dict()
+        result = []
+        for point in points:
+            key = tuple(axis(point) for axis in self.axises)
+            if key not in found:
+                found[key] = self.nearest_neighbour(point)
+            result.append(found[key])
+        return result
+
+class GridNeighbour:
+    """Approximate nearest neighbour from candidates precomputed per grid cell
+
+    The space within bounds, (low, high) per axis, is split into resolution
+    cells along every axis. Every cell keeps the candidates nearest to its
+    center that can be nearest to some point in the cell, at most candidates
+    of them. An answer is never more than max_error further from the point
+    than the exact nearest neighbour, for points within bounds.
+    """
+    def __init__(self, values, axises, resolution=16, candidates=4, bounds=None):
+        self.values = list(values)
+        self.axises = axises
+        self.cache = dict()
+        self.selected = set()
+        self.resolution = resolution
+        self.bounds = bounds or [(0, 255)] * len(axises)
+        self.sizes = [(high - low) / resolution for low, high in self.bounds]
+        # Any point of a cell is within reach of its center
+        reach = math.sqrt(sum((size / 2) ** 2 for size in self.sizes))
+        tree = KDTree(self.values, axises)
+        self.cells = []
+        self.max_error = 0
+        for cell in itertools.product(range(resolution), repeat=len(axises)):
+            center = tuple(low + (i + 0.5) * size for i, (low, _), size in zip(cell, self.bounds, self.sizes))
+            nearest = tree.nearest_to(center, candidates + 1)
+            if not nearest:
+                self.cells.append([])
+                continue
+            # The nearest neighbour of a point in the cell is at most this far from the center
+            limit = math.sqrt(nearest[0][0]) + 2 * reach
+            kept = [value for distance, value in nearest[:candidates] if math.sqrt(distance) <= limit]
+            if len(nearest) > candidates and math.sqrt(nearest[candidates][0]) <= limit:
+                error = min(limit - math.sqrt(nearest[candidates][0]), 2 * reach)
+                self.max_error = max(self.max_error, error)
+            self.cells.append([(tree.key(value), value) for value in kept])
+
+    def cell(self, key):
+        index = 0
+        for value, (low, _), size in zip(key, self.bounds, self.sizes):
+            i = min(max(int((value - low) / size), 0), self.resolution - 1)
+            index = index * self.resolution + i
+        return index
+
+    def nearest_neighbour(self, point):
+        if point in self.cache:
+            return self.cache[point]
+        key = tuple(axis(point) for axis in self.axises)
+        result = None
+        best_distance = math.inf
+        for candidate, value in self.cells[self.cell(key)]:
+            distance = 0
+            for a, b in zip(key, candidate):
+                distance += (a - b) * (a - b)
+            if distance < best_distance:
+                result = value
+                best_distance = distance
+        self.cache[point] = result
+        self.selected.add(result)
+        return result
+
+    def nearest_neighbours(self, points):
+        found = dict()
+        result = []
+        for point in points:
+            key = tuple(axis(point) for axis in self.axises)
+            if key not in found:
+                found[key] = self.nearest_neighbour(point)
+            result.append(found[key])
+        return result
+
+    def in_order(self):
+        return iter(self.values)
+
+    def copy(self):
+        """Returns a grid sharing the cells of this one, with an empty cache and selection"""
+        result = GridNeighbour.__new__(GridNeighbour)
+        result.__dict__.update(self.__dict__)
+        result.cache = dict()
+        result.selected = set()
+        return result
@@ -1,12 +1,13 @@
 #!/usr/bin/python3
 
+import glob
 import math
 import random
 import sys
 from PIL import Image
 
 import xstitch
-from kdtree import KDTree, NaiveNeighbour
+from kdtree import KDTree, NaiveNeighbour, GridNeighbour
 
 
 def range_1d_test():
@@ -36,14 +37,112 @@ def rand_1d_test():
             return False
     return True
 
+def layout_test():
+    input = [tuple(random.randint(0, 255) for _ in range(3)) for _ in range(200)]
+    axises = [lambda x: x[0], lambda x: x[1], lambda x: x[2]]
+    tree = KDTree(input, axises)
+    index = {value: i for i, value in enumerate(input)}
+    layout = [x for triple in tree.layout(lambda value: index[value]) for x in triple]
+    rebuilt = KDTree(input, axises, layout=layout)
+    naive = NaiveNeighbour(input, axises)
+    for _ in range(1000):
+        point = tuple(random.randint(0, 255) for _ in range(3))
+        a = rebuilt.nearest_neighbour(point)
+        b = naive.nearest_neighbour(point)
+        if tree.distance(point, a) != tree.distance(point, b):
+            print("ERROR: {} -> {} != {}".format(point, a, b))
+            return False
+    return True
+
+def bulk_test():
+    input = [tuple(random.randint(0, 255) for _ in range(3)) for _ in range(5000)]
+    axises = [lambda x: x[0], lambda x: x[1], lambda x: x[2]]
+    tree = KDTree(input, axises)
+    naive = NaiveNeighbour(input, axises)
+    points = [tuple(random.randint(0, 255) for _ in range(3)) for _ in range(500)]
+    points += points[:100]
+    for point, a in zip(points, tree.nearest_neighbours(points)):
+        b = naive.nearest_neighbour(point)
+        if tree.distance(point, a) != tree.distance(point, b):
+            print("ERROR: {} -> {} != {}".format(point, a, b))
+            return False
+    return True
+
+def copy_test():
+    input = [tuple(random.randint(0, 255) for _ in range(3)) for _ in range(500)]
+    axises = [lambda x: x[0], lambda x: x[1], lambda x: x[2]]
+    tree = KDTree(input, axises)
+    seen = [tuple(random.randint(0, 255) for _ in range(3)) for _ in range(2000)]
+    tree.nearest_neighbours(seen)
+    copy = tree.copy()
+    if copy.selected or copy.found != tree.found:
+        print("ERROR: copy has selection {} and {} of {} matches".format(len(copy.selected), len(copy.found), len(tree.found)))
+        return False
+    points = seen[:10] + [tuple(random.randint(0, 255) for _ in range(3)) for _ in range(10)]
+    matches = copy.nearest_neighbours(points)
+    if copy.selected != set(matches):
+        print("ERROR: selected {} != matched {}".format(len(copy.selected), len(set(matches))))
+        return False
+    if len(copy.found) > len(tree.found) + 10 or len(tree.found) != len(set(seen)):
+        print("ERROR: matches shared between the copy and the tree")
+        return False
+    return True
+
+def mismatch_rate(approximate, exact, points):
+    """Returns how often approximate differs from exact, and the largest extra distance it gave"""
+    points = list(points)
+    mismatches = 0
+    worst = 0
+    for point, a, b in zip(points, approximate.nearest_neighbours(points), exact.nearest_neighbours(points)):
+        if a is not b:
+            mismatches += 1
+            worst = max(worst, exact_distance(exact, point, a) - exact_distance(exact, point, b))
+    return mismatches / max(len(points), 1), worst
+
+def exact_distance(tree, pointa, pointb):
+    return math.sqrt(sum((axis(pointa) - axis(pointb))** 2 for axis in tree.axises))
+
+def approximate_test():
+    input = [tuple(random.randint(0, 255) for _ in range(3)) for _ in range(300)]
+    axises = [lambda x: x[0], lambda x: x[1], lambda x: x[2]]
+    approximate = GridNeighbour(input, axises, resolution=8, candidates=2)
+    naive = NaiveNeighbour(input, axises)
+    points = [tuple(random.randint(0, 255) for _ in range(3)) for _ in range(3000)]
+    rate, worst = mismatch_rate(approximate, naive, points)
+    print("mismatches: {:.2%}, worst: {:.2f}, bound: {:.2f}".format(rate, worst, approximate.max_error))
+    if worst > approximate.max_error + 1e-9:
+        print("ERROR: worst {} above bound {}".format(worst, approximate.max_error))
+        return False
+    exact = GridNeighbour(input, axises, resolution=8, candidates=len(input))
+    rate, worst = mismatch_rate(exact, naive, points)
+    if exact.max_error != 0 or worst != 0:
+        print("ERROR: unlimited candidates not exact, bound {}, worst {}".format(exact.max_error, worst))
+        return False
+    return True
+
+def approximate_image_test():
+    colors = xstitch.load_colors(CS("DMC1"))
+    approximate = GridNeighbour(colors, xstitch.axises)
+    naive = NaiveNeighbour(colors, xstitch.axises)
+    result = True
+    for filename in sorted(glob.glob("test/*.jpg")):
+        image = Image.open(filename).convert("RGB")
+        points = [xstitch.Color(*pixel) for pixel in set(image.getdata())]
+        rate, worst = mismatch_rate(approximate, naive, points)
+        print("{}: mismatches: {:.2%}, worst: {:.2f}, bound: {:.2f}".format(filename, rate, worst, approximate.max_error))
+        if worst > approximate.max_error + 1e-9:
+            result = False
+    return result
+
+class CS:
+    def __init__(self, v):
+        self.color_system_file = None
+        self.color_system = v
+
 def image_test():
     def distance(a, b):
         return math.sqrt((a.red-b.red)**2 + (a.green-b.green)**2 + (a.blue-b.blue)**2)
     image = Image.open("test/autumn-04.jpg")
-    class CS:
-        def __init__(self, v):
-            self.color_system_file = None
-            self.color_system = v
     colors = xstitch.load_colors(CS("DMC1"))
     width, height = 218, 218
     image.resize((width, height))
@@ -80,6 +179,11 @@ def run_tests(*fs):
 def main():
     run_tests(range_1d_test,
               rand_1d_test,
+              layout_test,
+              bulk_test,
+              copy_test,
+              approximate_test,
+              approximate_image_test,
               image_test)
 
 if __name__ == "__main__":
@@ -14,56 +14,133 @@ def groupby(items, key):
             result[value] = [item]
     return result
 
-def kmeans(k, values, axises):
+def kmeans(k, values, axises, progress=None, means=None):
     def apply_axises(item):
         return tuple(axis(item) for axis in axises)
 
-    def axis_grabber(x):
-        return lambda item: item[x]
-
-    random.seed(1337)
-    print(random.randint(0, 100000))
+    # Own generator, jobs running kmeans at the same time must not reseed each other
+    rng = random.Random(1337)
+    print(rng.randint(0, 100000))
 
     if isinstance(values, dict):
         new_values = []
         for item, count in values.items():
             new_values += [item]*count
         values = new_values
-    dimensions = len(axises)
-    tuple_axises = [axis_grabber(i) for i in range(dimensions)]
     values = [apply_axises(value) for value in values]
-    startingmeans = list(set(values))
-    random.shuffle(startingmeans)
-    means = startingmeans[:k]
+    if means is not None:
+        # Warm start, eg from a run on a sample of the values
+        means = [tuple(mean) for mean in means]
+    else:
+        startingmeans = list(set(values))
+        rng.shuffle(startingmeans)
+        means = startingmeans[:k]
 
-    # values = list(values)
-    random.shuffle(values)
-    means = values[:k]
+        # values = list(values)
+        rng.shuffle(values)
+        means = values[:k]
     # means = [apply_axises(value) for value in values[:k]]
 
+    histogram = dict()
+    for value in values:
+        histogram[value] = histogram.get(value, 0) + 1
+    means, _ = lloyd(histogram, means, progress)
+    return means
+
+def axis_grabber(x):
+    return lambda item: item[x]
+
+def lloyd(histogram, means, progress=None, iterations=1000, tolerance=0):
+    """kmeans from means over histogram, a dict of point tuples and their counts
+
+    Every distinct point is assigned once per iteration, weighted by its count.
+    Finishes once no mean moves further than tolerance along any axis.
+    Returns the means and the points nearest to each of them.
+    """
+    points = list(histogram)
+    dimensions = len(points[0]) if points else 0
+    tuple_axises = [axis_grabber(i) for i in range(dimensions)]
+    means = list(dict.fromkeys(tuple(mean) for mean in means))
+    clusters = []
     iteration = 0
     while True:
-        if iteration >= 1000:
+        if iteration >= iterations:
             break
         print(iteration)
+        if progress is not None:
+            progress(iteration, iterations)
         # Assignment
         tree = KDTree(means, tuple_axises)
-        groups = groupby(values, key=lambda x: tree.nearest_neighbour(x))
+        groups = groupby(zip(points, tree.nearest_neighbours(points)), key=lambda x: x[1])
+        clusters = [[point for point, _ in groups[mean]] for mean in means if mean in groups]
         # Update
         new_means = []
-        for _, items in groups.items():
+        for items in clusters:
             l = 0
             new_mean = [0]*dimensions
             for item in items:
-                l += 1
+                count = histogram[item]
+                l += count
                 for i in range(dimensions):
-                    new_mean[i] += item[i]
+                    new_mean[i] += item[i] * count
             new_mean = tuple(x / l for x in new_mean)
             new_means.append(new_mean)
-        if means == new_means:
+        new_means = list(dict.fromkeys(new_means))
+        if means == new_means or (tolerance and len(means) == len(new_means) and
+                                  all(abs(a - b) <= tolerance
+                                      for mean, new_mean in zip(means, new_means)
+                                      for a, b in zip(mean, new_mean))):
             print("\nKmeans finished after", iteration, "iterations")
-            return new_means
+            return new_means, clusters
         means = new_means
         iteration += 1
     print("\nERROR: Ran out of iterations", iteration)
+    return means, clusters
+
+def split(histogram, means, clusters, k):
+    """Adds means until there are k, each in the cluster with the largest error
+
+    The new mean starts at the point of the cluster furthest from its mean.
+    Stops early when no cluster has points left to split off.
+    """
+    means = list(means)
+    def distance(a, b):
+        return sum((x - y)**2 for x, y in zip(a, b))
+    errors = [sum(histogram[point] * distance(point, mean) for point in cluster)
+              for mean, cluster in zip(means, clusters)]
+    clusters = list(clusters)
+    while len(means) < k:
+        worst = max(range(len(errors)), key=lambda i: errors[i], default=None)
+        if worst is None or errors[worst] == 0:
+            break
+        mean = means[worst]
+        furthest = max(clusters[worst], key=lambda point: distance(point, mean))
+        # Share the points of the cluster between the old and the new mean
+        stays = [point for point in clusters[worst] if distance(point, mean) <= distance(point, furthest)]
+        moves = [point for point in clusters[worst] if distance(point, mean) > distance(point, furthest)]
+        clusters[worst] = stays
+        clusters.append(moves)
+        means.append(furthest)
+        errors[worst] = sum(histogram[point] * distance(point, mean) for point in stays)
+        errors.append(sum(histogram[point] * distance(point, furthest) for point in moves))
     return means
+
+def sweep(ks, histogram, progress=None, tolerance=1.0):
+    """kmeans for every k in ks over histogram, returns a dict of k and means
+
+    Starts from the mean of all points and reaches every k by splitting the
+    clusters of the previous, smaller k, then iterating from there until the
+    means move less than tolerance.
+    """
+    if not histogram:
+        return {k: [] for k in ks}
+    total = sum(histogram.values())
+    dimensions = len(next(iter(histogram)))
+    means = [tuple(sum(point[i] * count for point, count in histogram.items()) / total
+                   for i in range(dimensions))]
+    means, clusters = lloyd(histogram, means)
+    result = dict()
+    for k in sorted(set(ks)):
+        means, clusters = lloyd(histogram, split(histogram, means, clusters, k), progress, tolerance=tolerance)
+        result[k] = means
+    return result
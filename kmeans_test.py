@@ -0,0 +1,61 @@
+#!/usr/bin/python3
+
+import contextlib
+import io
+import random
+import sys
+
+from kmeans import sweep
+
+def error(histogram, means):
+    return sum(count * min(sum((a - b)**2 for a, b in zip(point, mean)) for mean in means)
+               for point, count in histogram.items())
+
+def sweep_test():
+    random.seed(7)
+    histogram = dict()
+    for _ in range(2000):
+        point = tuple(random.randint(0, 255) for _ in range(3))
+        histogram[point] = histogram.get(point, 0) + 1
+    ks = [2, 5, 10, 20]
+    with contextlib.redirect_stdout(io.StringIO()):
+        result = sweep(ks, histogram)
+    if sorted(result) != ks:
+        print("ERROR: counts {} != {}".format(sorted(result), ks))
+        return False
+    errors = []
+    for k in ks:
+        if len(result[k]) != k:
+            print("ERROR: {} means for k = {}".format(len(result[k]), k))
+            return False
+        errors.append(error(histogram, result[k]))
+    if errors != sorted(errors, reverse=True):
+        print("ERROR: error grows with more colors {}".format(errors))
+        return False
+    return True
+
+def sweep_few_points_test():
+    histogram = {(0, 0, 0): 5, (255, 255, 255): 3, (255, 0, 0): 1}
+    with contextlib.redirect_stdout(io.StringIO()):
+        result = sweep([2, 3, 6], histogram)
+    if sorted(result[3]) != sorted(histogram) or sorted(result[6]) != sorted(histogram):
+        print("ERROR: {}".format(result))
+        return False
+    return len(result[2]) == 2 and sweep([4], {}) == {4: []}
+
+
+def run_tests(*fs):
+    result = 0
+    for f in fs:
+        print("====", f.__name__, "====")
+        if not f():
+            result = 1
+            print(f.__name__, "failed")
+    sys.exit(result)
+
+def main():
+    run_tests(sweep_test,
+              sweep_few_points_test)
+
+if __name__ == "__main__":
+    main()
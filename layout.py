@@ -0,0 +1,157 @@
+#!/usr/bin/python3
+
+import math
+import re
+
+class Dimensions:
+    def __init__(self, name, width, height):
+        self.name = name
+        self.width = width
+        self.height = height
+    def transpose(self):
+        return Dimensions(self.name, self.height, self.width)
+
+paper_names = ["A5", "A4", "A3", "B5", "B4", "JIS-B5", "JIS-B4", "LETTER", "LEGAL", "LEDGER"]
+
+def page_dimensions(page="A4"):
+    """Returns Dimensions(name, width, height) in mm"""
+    D = Dimensions
+    # paper = {d.name:d for d in
+    #          [D("A0", 841, 1189),    D("B0", 1000, 1414),    D("C0", 917, 1297),
+    #           D("A1", 594,  841),    D("B1",  707, 1000),    D("C1", 648,  917),
+    #           D("A2", 420,  594),    D("B2",  500,  707),    D("C2", 458,  648),
+    #           D("A3", 297,  420),    D("B3",  353,  500),    D("C3", 324,  458),
+    #           D("A4", 210,  297),    D("B4",  250,  353),    D("C4", 229,  324),
+    #           D("A5", 148,  210),    D("B5",  176,  250),    D("C5", 162,  229),
+    #           D("A6", 105,  148),    D("B6",  125,  176),    D("C6", 114,  162),
+    #           D("A7",  74,  105),    D("B7",   88,  125),    D("C7",  81,  114),
+    #           D("A8",  52,   74),    D("B8",   62,   88),    D("C8",  57,   81),
+    #           D("A9",  37,   52),    D("B9",   44,   62),    D("C9",  40,   57),
+    #           D("A10", 26,   37),    D("B10",  31,   44),    D("C10", 28,   40),
+    #           D("A", 216, 279), D("B", 279, 432), D("C", 432, 559), D("D", 559, 864), D("E", 864, 1118),
+    #           D("LETTER", 216, 279), D("LEGAL", 216, 356), D("TABLOID", 279, 432), D("LEDGER", 432, 279),
+    #           D("Junior", 127, 203), D("Half", 140, 216), D("Memo", 140, 216)]}
+    paper = {d.name:d for d in
+             [D("A5", 148, 210),
+              D("A4", 210, 297),
+              D("A3", 297, 420),
+              D("B5", 176, 250),
+              D("B4", 250, 353),
+              D("JIS-B5", 182, 257),
+              D("JIS-B4", 257, 364),
+              D("LETTER", 216, 279),
+              D("LEGAL", 216, 356),
+              D("LEDGER", 432, 279)]}
+    page = page.upper().replace("ANSI", "").strip()
+    if page in paper:
+        return paper[page]
+    match = re.match(r"(\d+(?:\.\d+)?)\s*[*xX]\s*(\d+(?:\.\d+)?)$", page)
+    if match:
+        return D(page, float(match.group(1)), float(match.group(2)))
+    raise ValueError("page not supported '{}'".format(page))
+
+def px(mm):
+    return mm*3.78
+
+def papers(pages):
+    """Returns the Dimensions of a comma separated list of pages, 'auto' for every supported paper"""
+    if pages.strip().lower() == "auto":
+        return [page_dimensions(name) for name in paper_names]
+    return [page_dimensions(page) for page in pages.split(",")]
+
+def split(length, capacity, overlap=0):
+    """Splits length into the fewest, evenly sized (start, end) spans of at most capacity
+
+    Neighbouring spans share overlap rows.
+    """
+    if length <= capacity:
+        return [(0, length)]
+    if capacity <= overlap:
+        raise ValueError("overlap of {} does not fit on a page of {}".format(overlap, capacity))
+    count = math.ceil((length - overlap) / (capacity - overlap))
+    total = length + (count - 1) * overlap
+    result = []
+    start = 0
+    for i in range(count):
+        size = total // count + (1 if i < total % count else 0)
+        result.append((start, start + size))
+        start += size - overlap
+    return result
+
+class Tile:
+    def __init__(self, number, pagex, pagey, left, top, right, bottom):
+        self.number = number
+        self.pagex = pagex
+        self.pagey = pagey
+        self.left = left
+        self.top = top
+        self.right = right
+        self.bottom = bottom
+
+    def __contains__(self, position):
+        x, y = position
+        return self.left <= x < self.right and self.top <= y < self.bottom
+
+    def __repr__(self):
+        return "Tile({}, x={}-{}, y={}-{})".format(self.number, self.left, self.right, self.top, self.bottom)
+
+class Plan:
+    def __init__(self, page, capacity, columns, rows):
+        self.page = page
+        self.capacity = capacity
+        self.columns = columns
+        self.rows = rows
+
+    @property
+    def pages(self):
+        return len(self.columns) * len(self.rows)
+
+    @property
+    def orientation(self):
+        return "landscape" if self.page.width > self.page.height else "portrait"
+
+    def tiles(self):
+        number = 0
+        for pagey, (top, bottom) in enumerate(self.rows):
+            for pagex, (left, right) in enumerate(self.columns):
+                number += 1
+                yield Tile(number, pagex, pagey, left, top, right, bottom)
+
+    def __repr__(self):
+        return "Plan({} {}, {}x{} pages)".format(self.page.name, self.orientation, len(self.columns), len(self.rows))
+
+def plan_layout(size, pages, grid, border, margin, overlap=0):
+    """Returns the Plan printing a pattern of size on the fewest pages
+
+    Every page in pages is tried in both orientations, grid, border and margin
+    are in px. Ties go to the smaller paper, then to landscape.
+    """
+    width, height = size
+    plans = []
+    for paper in pages:
+        for page in (paper.transpose(), paper) if paper.width < paper.height else (paper, paper.transpose()):
+            capacity = (math.floor((px(page.width) - margin*2) / (grid + border)),
+                        math.floor((px(page.height) - margin*2) / (grid + border)))
+            if min(capacity) <= overlap:
+                continue
+            plans.append(Plan(page, capacity, split(width, capacity[0], overlap), split(height, capacity[1], overlap)))
+    if not plans:
+        raise ValueError("pages are too small for the grid")
+    return min(plans, key=lambda plan: (plan.pages, plan.page.width * plan.page.height, plan.orientation != "landscape"))
+
+def plan_pages(args, size):
+    """The Plan for a pattern of size with the page, grid, margin and overlap of args"""
+    return plan_layout(size, papers(args.page), math.floor(px(args.grid)), 1, px(args.margin), args.overlap)
+
+def create_layout(plan, width=80, height=120):
+    """Overview map of which part of the pattern is on which page, at most width by height mm"""
+    scale = min(width / plan.columns[-1][1], height / plan.rows[-1][1])
+    result = ['<table class="layout">']
+    for pagey, (top, bottom) in enumerate(plan.rows):
+        result.append('<tr style="height:{:.1f}mm;">'.format((bottom - top) * scale))
+        for pagex, (left, right) in enumerate(plan.columns):
+            result.append('<td style="width:{:.1f}mm;">{}</td>'.format(
+                (right - left) * scale, pagey * len(plan.columns) + pagex + 1))
+        result.append("</tr>")
+    result.append("</table>")
+    return "\n".join(result)
@@ -0,0 +1,92 @@
+#!/usr/bin/python3
+
+import math
+import re
+import sys
+
+import layout
+
+def split_test():
+    for length in range(1, 120):
+        for capacity in range(2, 40):
+            for overlap in range(0, min(capacity, 4)):
+                spans = layout.split(length, capacity, overlap)
+                sizes = [end - start for start, end in spans]
+                fewest = 1 if length <= capacity else math.ceil((length - overlap) / (capacity - overlap))
+                if (spans[0][0] != 0 or spans[-1][1] != length or len(spans) != fewest
+                    or max(sizes) > capacity or max(sizes) - min(sizes) > 1
+                    or any(a[1] - b[0] != overlap for a, b in zip(spans, spans[1:]))):
+                    print("ERROR: split({}, {}, {}) -> {}".format(length, capacity, overlap, spans))
+                    return False
+    try:
+        layout.split(100, 3, 3)
+    except ValueError:
+        return True
+    print("ERROR: overlap as large as the page was accepted")
+    return False
+
+def plan(size, pages="A4", grid=3.0, margin=10.0, overlap=0):
+    return layout.plan_layout(size, layout.papers(pages), math.floor(layout.px(grid)), 1, layout.px(margin), overlap)
+
+def plan_layout_test():
+    result = True
+    def check(name, value, expected):
+        nonlocal result
+        if value != expected:
+            print("ERROR: {}: {} != {}".format(name, value, expected))
+            result = False
+    small = plan((10, 10))
+    check("small pages", small.pages, 1)
+    check("small orientation", small.orientation, "landscape")
+    wide, tall = plan((80, 20)), plan((20, 80))
+    check("wide orientation", wide.orientation, "landscape")
+    check("tall orientation", tall.orientation, "portrait")
+    check("tall pages", tall.pages, 1)
+    # A5 holds the pattern on as few pages as A4 does, so the smaller paper wins
+    check("smallest paper", plan((30, 30), "A4,A5").page.name, "A5")
+    check("fewest pages", plan((120, 160), "A5,A3").page.name, "A3")
+    big = plan((500, 300), overlap=3)
+    tiles = list(big.tiles())
+    check("tile count", len(tiles), big.pages)
+    check("tile numbers", [tile.number for tile in tiles], list(range(1, big.pages + 1)))
+    for x, y in [(0, 0), (499, 299), (250, 150)]:
+        if not any((x, y) in tile for tile in tiles):
+            print("ERROR: ({}, {}) is on no page".format(x, y))
+            result = False
+    for pages, grid in [("A4,", 3.0), ("A4", 500.0)]:
+        try:
+            plan((100, 100), pages, grid)
+        except ValueError:
+            continue
+        print("ERROR: pages '{}' with grid {} were accepted".format(pages, grid))
+        result = False
+    return result
+
+def create_layout_test():
+    for size in [(50, 1000), (1000, 50), (300, 300), (10, 10)]:
+        html = layout.create_layout(plan(size))
+        widths = [float(x) for x in re.findall(r'<td style="width:([\d.]+)mm', html)]
+        heights = [float(x) for x in re.findall(r'<tr style="height:([\d.]+)mm', html)]
+        columns = len(widths) // len(heights)
+        if sum(widths[:columns]) > 80.5 or sum(heights) > 120.5:
+            print("ERROR: map of {} is {:.1f}x{:.1f}mm".format(size, sum(widths[:columns]), sum(heights)))
+            return False
+    return True
+
+
+def run_tests(*fs):
+    result = 0
+    for f in fs:
+        print("====", f.__name__, "====")
+        if not f():
+            result = 1
+            print(f.__name__, "failed")
+    sys.exit(result)
+
+def main():
+    run_tests(split_test,
+              plan_layout_test,
+              create_layout_test)
+
+if __name__ == "__main__":
+    main()
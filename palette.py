@@ -0,0 +1,210 @@
+#!/usr/bin/python3
+
+import array
+import csv
+import glob
+import mmap
+import os
+import pathlib
+import struct
+
+from kdtree import KDTree
+
+scriptdir = os.path.dirname(os.path.abspath(__file__))
+color_system_format = ["name", "description", "red", "green", "blue", "hex"]
+
+# Compiled palettes live next to their csv file, in
+# __pycache__/<csv name>.<axises name>.xspal as the tree depends on the axises
+#
+# header:  magic, source mtime (ns), source size, number of colors
+# rgb:     3*count unsigned bytes
+# hsv:     3*count doubles
+# lab:     3*count doubles
+# tree:    3*count int32, (pivot, left, right) per node in preorder, -1 for no child
+# strings: name, description and hex of every color, utf-8 separated by NUL
+magic = b"XSPAL\x00\x01\x00"
+header_format = struct.Struct("<8sqqI4x")
+
+def rgb_to_hsv(red, green, blue):
+    r = red/255.0
+    g = green/255.0
+    b = blue/255.0
+    m = min(r,g,b)
+    M = max(r,g,b)
+    v = M
+    delta = M - m
+    if v == 0:
+        return (0, 0, v)
+    else:
+        s = delta / M
+
+    if delta == 0:
+        h = 0
+    elif M == b:
+        h = (r-g)/delta + 4
+    elif M == g:
+        h = (b-r)/delta + 2
+    else:
+        h = ((g - b)/delta)
+    h *= 60
+    if h < 0:
+        h += 360
+    return (h, s, v)
+
+def rgb_to_lab(red, green, blue):
+    """Returns CIE L*a*b* of an sRGB color, using the D65 white point"""
+    def linear(c):
+        c = c/255.0
+        if c <= 0.04045:
+            return c / 12.92
+        return ((c + 0.055) / 1.055) ** 2.4
+    def f(t):
+        if t > (6/29)**3:
+            return t ** (1/3)
+        return t / (3 * (6/29)**2) + 4/29
+    r, g, b = linear(red), linear(green), linear(blue)
+    x = (0.4124564*r + 0.3575761*g + 0.1804375*b) / 0.95047
+    y = (0.2126729*r + 0.7151522*g + 0.0721750*b) / 1.00000
+    z = (0.0193339*r + 0.1191920*g + 0.9503041*b) / 1.08883
+    fx, fy, fz = f(x), f(y), f(z)
+    return (116*fy - 16, 500*(fx - fy), 200*(fy - fz))
+
+def align(offset):
+    return (offset + 7) & ~7
+
+class Palette:
+    def __init__(self, filename, stamp, rgb, hsv, lab, layout, strings, factory, axises):
+        self.filename = filename
+        self.stamp = stamp
+        self.rgb = rgb
+        self.hsv = hsv
+        self.lab = lab
+        self.layout = layout
+        self.colors = [factory(rgb[i*3], rgb[i*3+1], rgb[i*3+2],
+                               strings[i*3], strings[i*3+1], strings[i*3+2],
+                               hsv=tuple(hsv[i*3:i*3+3]), lab=tuple(lab[i*3:i*3+3]))
+                       for i in range(len(rgb)//3)]
+        self.nodes = KDTree(self.colors, axises, layout=layout)
+        # Further indexes built from the colors, kept as long as the palette
+        self.derived = dict()
+
+    def __len__(self):
+        return len(self.colors)
+
+    def tree(self):
+        """Returns a KDTree over the palette with its own cache and selection"""
+        return self.nodes.copy()
+
+    def __repr__(self):
+        return "Palette({}, {} colors)".format(self.filename.name, len(self))
+
+class PaletteRegistry:
+    """Compiles color system csv files once and shares the result
+
+    Palettes are kept in memory for the lifetime of the registry and stored
+    compiled on disk, a compiled palette is used as long as the modification
+    time and size of its csv file are unchanged.
+    The stored tree is built with the axises of the registry, name tells them
+    apart from those of other registries compiling the same csv files.
+    """
+    def __init__(self, factory, axises, name, directory=None):
+        self.factory = factory
+        self.axises = axises
+        self.name = name
+        self.directory = pathlib.Path(directory or pathlib.Path(scriptdir, "color-systems"))
+        self.palettes = dict()
+
+    def available(self):
+        return sorted(pathlib.Path(p).stem for p in glob.glob(str(pathlib.Path(self.directory, "*.csv"))))
+
+    def path(self, name):
+        return pathlib.Path(self.directory, name + ".csv")
+
+    def load(self, filename):
+        filename = pathlib.Path(filename).resolve()
+        stat = filename.stat()
+        stamp = (stat.st_mtime_ns, stat.st_size)
+        palette = self.palettes.get(filename)
+        if palette is not None and palette.stamp == stamp:
+            return palette
+        compiled = self.compiled_path(filename)
+        palette = self.read(filename, compiled, stamp)
+        if palette is None:
+            palette = self.compile(filename, stamp)
+            self.write(palette, compiled)
+        self.palettes[filename] = palette
+        return palette
+
+    def compiled_path(self, filename):
+        return pathlib.Path(filename.parent, "__pycache__", "{}.{}.xspal".format(filename.stem, self.name))
+
+    def compile(self, filename, stamp):
+        with filename.open(newline='') as csvfile:
+            rows = list(csv.DictReader(csvfile, fieldnames=color_system_format))
+        rgb = array.array("B")
+        hsv = array.array("d")
+        lab = array.array("d")
+        strings = []
+        for row in rows:
+            color = (int(row["red"]), int(row["green"]), int(row["blue"]))
+            rgb.extend(color)
+            hsv.extend(rgb_to_hsv(*color))
+            lab.extend(rgb_to_lab(*color))
+            strings += [row["name"] or "", row["description"] or "", row["hex"] or ""]
+        colors = [self.factory(rgb[i*3], rgb[i*3+1], rgb[i*3+2]) for i in range(len(rows))]
+        index = {id(color): i for i, color in enumerate(colors)}
+        layout = array.array("i")
+        for triple in KDTree(colors, self.axises).layout(lambda color: index[id(color)]):
+            layout.extend(triple)
+        return Palette(filename, stamp, memoryview(rgb), memoryview(hsv), memoryview(lab),
+                       memoryview(layout), strings, self.factory, self.axises)
+
+    def read(self, filename, compiled, stamp):
+        try:
+            with compiled.open("rb") as file:
+                data = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError):
+            return None
+        if len(data) < header_format.size:
+            return None
+        found, mtime, size, count = header_format.unpack_from(data)
+        if found != magic or (mtime, size) != stamp:
+            return None
+        view = memoryview(data)
+        offset = header_format.size
+        rgb = view[offset:offset + 3*count]
+        offset = align(offset + 3*count)
+        hsv = view[offset:offset + 3*8*count].cast("d")
+        offset += 3*8*count
+        lab = view[offset:offset + 3*8*count].cast("d")
+        offset += 3*8*count
+        layout = view[offset:offset + 3*4*count].cast("i")
+        offset = align(offset + 3*4*count)
+        strings = bytes(view[offset:]).decode("utf-8").split("\0") if count else []
+        if len(strings) != 3*count:
+            return None
+        return Palette(filename, stamp, rgb, hsv, lab, layout, strings, self.factory, self.axises)
+
+    def write(self, palette, compiled):
+        count = len(palette)
+        header = header_format.pack(magic, palette.stamp[0], palette.stamp[1], count)
+        strings = "\0".join(s for c in palette.colors for s in (c.name, c.description, c.hex))
+        temporary = compiled.with_name("{}.{}.tmp".format(compiled.name, os.getpid()))
+        try:
+            compiled.parent.mkdir(exist_ok=True)
+            with temporary.open("wb") as file:
+                file.write(header)
+                file.write(palette.rgb)
+                file.write(bytes(align(len(header) + 3*count) - len(header) - 3*count))
+                file.write(palette.hsv)
+                file.write(palette.lab)
+                file.write(palette.layout)
+                file.write(bytes(align(3*4*count) - 3*4*count))
+                file.write(strings.encode("utf-8"))
+            os.replace(str(temporary), str(compiled))
+        except OSError:
+            # A read only color system directory just means compiling every run
+            try:
+                temporary.unlink()
+            except OSError:
+                pass
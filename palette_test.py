@@ -0,0 +1,128 @@
+#!/usr/bin/python3
+
+import mmap
+import os
+import pathlib
+import random
+import sys
+import tempfile
+
+import xstitch
+from kdtree import NaiveNeighbour
+from palette import PaletteRegistry
+
+def write_palette(path, rgbs):
+    with path.open("w") as file:
+        for i, rgb in enumerate(rgbs):
+            file.write("{},Color {},{},{},{},{:02X}{:02X}{:02X}\n".format(i, i, *rgb, *rgb))
+
+def random_rgbs(count):
+    return [tuple(random.randint(0, 255) for _ in range(3)) for _ in range(count)]
+
+def same_matches(palette, axises):
+    tree = palette.tree()
+    naive = NaiveNeighbour(palette.colors, axises)
+    for rgb in random_rgbs(500):
+        point = xstitch.Color(*rgb)
+        a, b = tree.nearest_neighbour(point), naive.nearest_neighbour(point)
+        if tree.distance(point, a) != tree.distance(point, b):
+            print("ERROR: {} -> {} != {}".format(rgb, a, b))
+            return False
+    return True
+
+def compile_test():
+    random.seed(3)
+    rgbs = random_rgbs(200)
+    with tempfile.TemporaryDirectory() as directory:
+        path = pathlib.Path(directory, "test.csv")
+        write_palette(path, rgbs)
+        compiled = PaletteRegistry(xstitch.Color, xstitch.axises, "rgb", directory).load(path)
+        if not PaletteRegistry(xstitch.Color, xstitch.axises, "rgb", directory).compiled_path(path.resolve()).exists():
+            print("ERROR: the palette was not stored")
+            return False
+        # A new registry reads the stored palette back
+        read = PaletteRegistry(xstitch.Color, xstitch.axises, "rgb", directory).load(path)
+        if not isinstance(read.rgb.obj, mmap.mmap):
+            print("ERROR: the stored palette was not read")
+            return False
+        if read.layout.tolist() != compiled.layout.tolist():
+            print("ERROR: the stored tree differs")
+            return False
+        for a, b in zip(compiled.colors, read.colors):
+            if (a.rgb(), a.name, a.description, a.hex, a.hsv(), a.lab()) != (b.rgb(), b.name, b.description, b.hex, b.hsv(), b.lab()):
+                print("ERROR: {} != {}".format(a, b))
+                return False
+        if [c.rgb() for c in read.colors] != rgbs:
+            print("ERROR: the colors differ from the csv")
+            return False
+        return same_matches(read, xstitch.axises)
+
+def axises_test():
+    random.seed(4)
+    reversed_axises = [lambda c: c.blue, lambda c: c.green, lambda c: c.red]
+    with tempfile.TemporaryDirectory() as directory:
+        path = pathlib.Path(directory, "test.csv")
+        write_palette(path, random_rgbs(300))
+        PaletteRegistry(xstitch.Color, xstitch.axises, "rgb", directory).load(path)
+        palette = PaletteRegistry(xstitch.Color, reversed_axises, "bgr", directory).load(path)
+        return same_matches(palette, reversed_axises)
+
+def reload_test():
+    random.seed(5)
+    with tempfile.TemporaryDirectory() as directory:
+        path = pathlib.Path(directory, "test.csv")
+        write_palette(path, random_rgbs(50))
+        registry = PaletteRegistry(xstitch.Color, xstitch.axises, "rgb", directory)
+        first = registry.load(path)
+        if registry.load(path) is not first:
+            print("ERROR: an unchanged palette was loaded again")
+            return False
+        rgbs = random_rgbs(60)
+        write_palette(path, rgbs)
+        stat = path.stat()
+        # Make sure the change shows even on coarse file system clocks
+        os.utime(str(path), ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+        for loaded in (registry.load(path), PaletteRegistry(xstitch.Color, xstitch.axises, "rgb", directory).load(path)):
+            if [c.rgb() for c in loaded.colors] != rgbs:
+                print("ERROR: the changed csv was not compiled again")
+                return False
+            if not same_matches(loaded, xstitch.axises):
+                return False
+        return True
+
+def read_only_test():
+    random.seed(6)
+    rgbs = random_rgbs(40)
+    with tempfile.TemporaryDirectory() as directory:
+        path = pathlib.Path(directory, "test.csv")
+        write_palette(path, rgbs)
+        # A file where the cache directory should be, nothing can be stored
+        pathlib.Path(directory, "__pycache__").write_bytes(b"")
+        for _ in range(2):
+            palette = PaletteRegistry(xstitch.Color, xstitch.axises, "rgb", directory).load(path)
+            if [c.rgb() for c in palette.colors] != rgbs or not same_matches(palette, xstitch.axises):
+                print("ERROR: loading without a writable cache failed")
+                return False
+        if any(p.suffix == ".tmp" for p in pathlib.Path(directory).iterdir()):
+            print("ERROR: temporary files were left behind")
+            return False
+        return True
+
+
+def run_tests(*fs):
+    result = 0
+    for f in fs:
+        print("====", f.__name__, "====")
+        if not f():
+            result = 1
+            print(f.__name__, "failed")
+    sys.exit(result)
+
+def main():
+    run_tests(compile_test,
+              axises_test,
+              reload_test,
+              read_only_test)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,284 @@
+#!/usr/bin/python3
+
+import asyncio
+import concurrent.futures
+import io
+import sys
+import threading
+
+from PIL import Image
+
+import xstitch
+import report
+import export
+import layout
+
+class JobError(Exception):
+    pass
+
+class Cancelled(Exception):
+    pass
+
+class CancelToken:
+    """Shared between a job and whoever may want to stop it, from any thread"""
+    def __init__(self):
+        self.event = threading.Event()
+
+    def cancel(self):
+        self.event.set()
+
+    @property
+    def cancelled(self):
+        return self.event.is_set()
+
+    def check(self):
+        if self.event.is_set():
+            raise Cancelled()
+
+class Progress:
+    def __init__(self, stage, done, total):
+        self.stage = stage
+        self.done = done
+        self.total = total
+
+    @property
+    def fraction(self):
+        return self.done / self.total if self.total else 1.0
+
+    def __repr__(self):
+        return "Progress({}, {}/{})".format(self.stage, self.done, self.total)
+
+class Preview:
+    def __init__(self, name, image):
+        self.name = name
+        self.image = image
+
+    def __repr__(self):
+        return "Preview({}, {}x{})".format(self.name, self.image.width, self.image.height)
+
+class Job:
+    """One conversion from an image to a pattern, run a stage at a time
+
+    output is the path or binary file the result is streamed to: the pdf,
+    the pattern file when args.format is 'xsp' or the contact sheet of a
+    sweep. input is a path, '-' for stdin, bytes or a binary file, by default
+    args.input. The state of every stage is kept on the job.
+    """
+    stages = ["load", "resize", "colors", "reduce", "convert", "render"]
+    # When args.colors is a list of counts, giving a contact sheet instead of a pdf
+    sweep_stages = ["load", "resize", "colors", "sweep", "sheet"]
+    # Stages of every pass of passes(), each pass yields a preview when done
+    refinements = [("draft", ["load", "resize", "colors", "draft"]),
+                   ("match", ["convert"]),
+                   ("reduce", ["reduce", "convert"]),
+                   ("render", ["render"])]
+    # Longest side of the image used for the draft
+    draft_size = 64
+
+    def __init__(self, args, output, input=None, token=None):
+        self.args = args
+        self.output = output
+        self.input = input if input is not None else args.input
+        self.token = token or CancelToken()
+        self.image = None
+        self.palette = None
+        self.color_tree = None
+        self.final_color_tree = None
+        self.means = None
+        self.converted = None
+        self.preview = None
+        self.reductions = None
+        self.report = None
+
+    def load(self, progress):
+        source = self.input
+        if source == "-":
+            source = io.BytesIO(sys.stdin.buffer.read())
+        elif isinstance(source, (bytes, bytearray, memoryview)):
+            source = io.BytesIO(source)
+        try:
+            self.image = Image.open(source)
+            self.image.load()
+        except FileNotFoundError:
+            raise JobError("file not found '{}'".format(self.input))
+        except IOError:
+            raise JobError("File is not a readable image '{}'".format(self.input if isinstance(self.input, str) else "<stream>"))
+
+    def resize(self, progress):
+        if self.args.size:
+            try:
+                self.image = xstitch.resize(self.image, self.args.size)
+            except ValueError as error:
+                raise JobError(str(error))
+
+    def colors(self, progress):
+        try:
+            self.palette = xstitch.load_palette(self.args)
+        except FileNotFoundError as error:
+            raise JobError("color system not found '{}'".format(error.filename))
+        try:
+            self.color_tree = xstitch.color_tree(self.args, self.palette)
+        except ValueError as error:
+            raise JobError(str(error))
+
+    def reduce(self, progress):
+        if self.args.colors is not None:
+            self.final_color_tree, self.means = xstitch.reduce_colors(self.image, self.color_tree, self.args.colors, progress, self.means)
+        else:
+            self.final_color_tree = self.color_tree
+
+    def draft(self, progress):
+        """Reduces and converts a small copy of the image, as a first preview"""
+        sample = self.image.convert("RGB")
+        sample.thumbnail((self.draft_size, self.draft_size), Image.BOX)
+        self.final_color_tree = self.color_tree
+        if self.args.colors is not None:
+            self.final_color_tree, self.means = xstitch.reduce_colors(sample, self.color_tree, self.args.colors, progress)
+        converted = xstitch.color_convert(sample, self.final_color_tree, progress=progress)
+        self.preview = converted.resize(self.image.size, Image.NEAREST)
+
+    def convert(self, progress):
+        # A fresh selection, or colors only matched by an earlier pass, such
+        # as the draft, would be taken as used. Matches already found are kept
+        self.final_color_tree = self.final_color_tree.copy()
+        self.converted = self.preview = xstitch.color_convert(self.image, self.final_color_tree, progress=progress)
+        if self.args.blend and self.args.max_blends is not None:
+            limited_color_tree = xstitch.limit_blends(self.final_color_tree, self.palette.colors, self.converted, self.args.max_blends)
+            if limited_color_tree is not self.final_color_tree:
+                self.final_color_tree = limited_color_tree
+                self.converted = self.preview = xstitch.color_convert(self.image, self.final_color_tree, progress=progress)
+        if self.args.colors is not None and len(self.final_color_tree.selected) != self.args.colors:
+            print("Warning: Fewer than the wanted colors ended up being used ({} != {})".format(len(self.final_color_tree.selected), self.args.colors))
+
+    def sweep(self, progress):
+        self.reductions = xstitch.color_sweep(self.image, self.color_tree, self.args.colors, progress)
+        for reduction in self.reductions:
+            print("{:4} colors: mean Delta E {:.2f}".format(len(reduction.colors), reduction.error))
+
+    def sheet(self, progress):
+        xstitch.contact_sheet(self.reductions).save(self.output, "PNG")
+
+    def render(self, progress):
+        try:
+            layout.plan_pages(self.args, self.converted.size)
+        except ValueError as error:
+            raise JobError(str(error))
+        if self.args.format == "xsp":
+            # No layout at all, whoever reads the file renders what it needs
+            export.write(self.output, self.converted, self.final_color_tree.selected, self.args)
+            return
+        self.report = report.create(self.args, self.converted, self.final_color_tree.selected, self.output)
+
+    def edit(self, changes, output):
+        """Changes stitches after rendering and writes the pdf again to output
+
+        changes maps (x, y) to a Color, only the pages holding changed stitches
+        and the front page are laid out again.
+        """
+        if self.report is None:
+            raise JobError("edits need a rendered pdf")
+        self.report.edit(changes)
+        self.report.write(output)
+
+    def stage(self, name, report_progress):
+        """Runs one stage, report_progress gets a Progress whenever the stage makes some"""
+        def progress(done, total):
+            self.token.check()
+            report_progress(Progress(name, done, total))
+        self.token.check()
+        getattr(self, name)(progress)
+
+    def steps(self, report_progress=None):
+        """Runs the job, yielding a Progress as every stage starts and finishes
+
+        Progress inside a stage goes to report_progress, cancelling the token
+        raises Cancelled from the next step or progress report.
+        """
+        for name in self.sweep_stages if isinstance(self.args.colors, list) else self.stages:
+            self.token.check()
+            yield Progress(name, 0, 1)
+            self.stage(name, report_progress or (lambda event: None))
+            yield Progress(name, 1, 1)
+
+    def passes(self, report_progress=None):
+        """Runs the job as passes refining the result, yielding a Preview after each
+
+        The draft is converted from a small copy of the image, the match pass
+        converts the full image with the draft colors, the reduce pass chooses
+        the final colors starting from the draft and the render pass writes
+        the pdf. Every pass builds on the state left by the one before.
+        """
+        if isinstance(self.args.colors, list):
+            raise JobError("passes need a single number of colors")
+        for name, stages in self.refinements:
+            if name == "reduce" and self.args.colors is None:
+                continue
+            for stage in stages:
+                self.stage(stage, report_progress or (lambda event: None))
+            yield Preview(name, self.preview)
+
+    async def refine(self, executor=None):
+        """Runs passes() on executor, yielding every Preview as soon as it is ready
+
+        executor must run in this process, see run().
+        """
+        check_executor(executor)
+        loop = asyncio.get_running_loop()
+        passes = self.passes()
+        try:
+            while True:
+                preview = await loop.run_in_executor(executor, next, passes, None)
+                if preview is None:
+                    return
+                yield preview
+        except (asyncio.CancelledError, GeneratorExit):
+            self.token.cancel()
+            raise
+
+    async def run(self, executor=None):
+        """Runs the job on executor, yielding every Progress as it happens
+
+        Closing the generator or cancelling the task consuming it cancels the
+        job, the stage running at that time stops at its next progress report.
+
+        The stages work on the state of the job itself, so executor has to
+        run in this process: a thread pool, or None for the default one.
+        They hold the GIL, so a pool keeps the event loop responsive and
+        runs several jobs side by side but not faster than one after another.
+        """
+        check_executor(executor)
+        loop = asyncio.get_running_loop()
+        events = asyncio.Queue()
+        def report_progress(event):
+            loop.call_soon_threadsafe(events.put_nowait, event)
+        future = get = None
+        try:
+            for name in self.sweep_stages if isinstance(self.args.colors, list) else self.stages:
+                self.token.check()
+                yield Progress(name, 0, 1)
+                future = loop.run_in_executor(executor, self.stage, name, report_progress)
+                while True:
+                    get = asyncio.ensure_future(events.get())
+                    done, _ = await asyncio.wait({future, get}, return_when=asyncio.FIRST_COMPLETED)
+                    if get in done:
+                        yield get.result()
+                        continue
+                    get.cancel()
+                    break
+                await future
+                while not events.empty():
+                    yield events.get_nowait()
+                yield Progress(name, 1, 1)
+        except (asyncio.CancelledError, GeneratorExit):
+            self.token.cancel()
+            if get is not None:
+                get.cancel()
+            if future is not None:
+                # Nobody waits for the stage any more, it ends with Cancelled
+                future.add_done_callback(lambda future: future.cancelled() or future.exception())
+            raise
+
+def check_executor(executor):
+    # Jobs hold images, trees and lambdas that can not be sent to another process
+    if isinstance(executor, concurrent.futures.ProcessPoolExecutor):
+        raise TypeError("jobs can only run on thread executors")
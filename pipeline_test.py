@@ -0,0 +1,239 @@
+#!/usr/bin/python3
+
+import asyncio
+import contextlib
+import gc
+import io
+import pathlib
+import random
+import sys
+import tempfile
+from PIL import Image
+
+import xstitch
+import pipeline
+
+# Black, white and the greys in between
+greys = [(0, 0, 0), (255, 255, 255)] + [(v, v, v) for v in range(16, 255, 16)]
+
+def write_palette(directory, rgbs):
+    path = pathlib.Path(directory, "test.csv")
+    with path.open("w") as file:
+        for i, rgb in enumerate(rgbs):
+            file.write("{},Color {},{},{},{},{:02X}{:02X}{:02X}\n".format(i, i, *rgb, *rgb))
+    return str(path)
+
+def checkerboard(size, a, b):
+    image = Image.new("RGB", (size, size))
+    image.putdata([a if (x + y) % 2 else b for y in range(size) for x in range(size)])
+    return image
+
+def image_bytes(image):
+    buffer = io.BytesIO()
+    image.save(buffer, "PNG")
+    return buffer.getvalue()
+
+def random_image(width, height):
+    image = Image.new("RGB", (width, height))
+    image.putdata([tuple(random.randint(0, 255) for _ in range(3)) for _ in range(width * height)])
+    return image
+
+@contextlib.contextmanager
+def random_job(**arguments):
+    """A job reducing a random image to 6 colors of a random palette, written as xsp"""
+    random.seed(8)
+    rgbs = [tuple(random.randint(0, 255) for _ in range(3)) for _ in range(40)]
+    image = random_image(60, 40)
+    arguments = dict(dict(colors=6, format="xsp"), **arguments)
+    with tempfile.TemporaryDirectory() as directory:
+        args = xstitch.default_arguments(color_system_file=write_palette(directory, rgbs), **arguments)
+        with contextlib.redirect_stdout(io.StringIO()):
+            yield pipeline.Job(args, io.BytesIO(), input=image_bytes(image))
+
+def check_events(events, stages):
+    """Every stage starts, reports progress within itself and finishes, in order"""
+    starts = [event.stage for event in events if event.done == 0 and event.total == 1]
+    ends = [event.stage for event in events if event.done == 1 and event.total == 1]
+    if starts != stages or ends != stages:
+        print("ERROR: stages {} {} != {}".format(starts, ends, stages))
+        return False
+    stage = None
+    for event in events:
+        if event.total == 1 and event.done == 0:
+            stage = event.stage
+        elif event.stage != stage:
+            print("ERROR: {} outside its stage".format(event))
+            return False
+    if not any(event.total > 1 for event in events if event.stage == "reduce"):
+        print("ERROR: no progress from reduce")
+        return False
+    return True
+
+def steps_test():
+    with random_job() as job:
+        progress = []
+        events = []
+        for event in job.steps(progress.append):
+            events.append(event)
+            events += progress
+            del progress[:]
+    return check_events(events, job.stages) and job.output.getvalue().startswith(b"XSTITCH")
+
+def run_test():
+    async def run(job):
+        return [event async for event in job.run()]
+    with random_job() as job:
+        events = asyncio.run(run(job))
+    return check_events(events, job.stages) and job.output.getvalue().startswith(b"XSTITCH")
+
+def refine_test():
+    async def refine(job):
+        return [preview async for preview in job.refine()]
+    with random_job() as job:
+        previews = asyncio.run(refine(job))
+    names = [preview.name for preview in previews]
+    if names != ["draft", "match", "reduce", "render"]:
+        print("ERROR: passes {}".format(names))
+        return False
+    if any(preview.image.size != (60, 40) for preview in previews):
+        print("ERROR: preview sizes {}".format([preview.image.size for preview in previews]))
+        return False
+    return job.output.getvalue().startswith(b"XSTITCH")
+
+def cancel_test():
+    result = True
+    with random_job() as job:
+        job.token.cancel()
+        try:
+            next(job.steps())
+            print("ERROR: a cancelled job started")
+            result = False
+        except pipeline.Cancelled:
+            pass
+    # Cancelled from another thread in the middle of a stage
+    def cancel_in(job, stage):
+        def report_progress(event):
+            if event.stage == stage:
+                job.token.cancel()
+        return report_progress
+    with random_job() as job:
+        try:
+            for event in job.steps(cancel_in(job, "reduce")):
+                pass
+            print("ERROR: the job was not cancelled")
+            result = False
+        except pipeline.Cancelled:
+            if job.converted is not None:
+                print("ERROR: stages ran after cancelling")
+                result = False
+    # Closing run() in the middle of a stage cancels the job and leaves no errors behind
+    errors = []
+    async def close(job):
+        asyncio.get_running_loop().set_exception_handler(lambda loop, context: errors.append(context["message"]))
+        events = job.run()
+        async for event in events:
+            if event.stage == "reduce" and event.total > 1:
+                break
+        await events.aclose()
+        await asyncio.sleep(0.5)
+        gc.collect()
+    with random_job(colors=30) as job:
+        asyncio.run(close(job))
+        if not job.token.cancelled or job.converted is not None or errors:
+            print("ERROR: closing run(): cancelled {}, errors {}".format(job.token.cancelled, errors))
+            result = False
+    # As does cancelling the task consuming it
+    async def cancel(job):
+        async def consume():
+            async for event in job.run():
+                if event.stage == "reduce" and event.total > 1:
+                    task.cancel()
+        task = asyncio.ensure_future(consume())
+        try:
+            await task
+        except asyncio.CancelledError:
+            return True
+        return False
+    with random_job(colors=30) as job:
+        if not asyncio.run(cancel(job)) or not job.token.cancelled:
+            print("ERROR: cancelling the task did not cancel the job")
+            result = False
+    return result
+
+def passes_test():
+    image = checkerboard(200, (0, 0, 0), (255, 255, 255))
+    with tempfile.TemporaryDirectory() as directory:
+        args = xstitch.default_arguments(color_system_file=write_palette(directory, greys))
+        job = pipeline.Job(args, input=image_bytes(image), output=io.BytesIO())
+        with contextlib.redirect_stdout(io.StringIO()):
+            for preview in job.passes():
+                if preview.name == "match":
+                    break
+    used = set(rgb for _, rgb in job.converted.getcolors())
+    selected = set(color.rgb() for color in job.final_color_tree.selected)
+    if used != selected:
+        print("ERROR: selected {} != used {}".format(sorted(selected), sorted(used)))
+        return False
+    return True
+
+def export_edit_test():
+    image = checkerboard(20, (0, 0, 0), (255, 255, 255))
+    with tempfile.TemporaryDirectory() as directory:
+        args = xstitch.default_arguments(color_system_file=write_palette(directory, greys), format="xsp")
+        output = io.BytesIO()
+        job = pipeline.Job(args, input=image_bytes(image), output=output)
+        with contextlib.redirect_stdout(io.StringIO()):
+            for event in job.steps():
+                pass
+    if not output.getvalue().startswith(b"XSTITCH"):
+        print("ERROR: no pattern file was written")
+        return False
+    try:
+        job.edit({(0, 0): (0, 0, 0)}, io.BytesIO())
+    except pipeline.JobError:
+        return True
+    print("ERROR: an exported job was edited")
+    return False
+
+def max_blends_test():
+    random.seed(2)
+    rgbs = [tuple(random.randint(0, 255) for _ in range(3)) for _ in range(60)]
+    image = Image.new("RGB", (60, 40))
+    image.putdata([tuple(random.randint(0, 255) for _ in range(3)) for _ in range(60 * 40)])
+    result = True
+    with tempfile.TemporaryDirectory() as directory:
+        palette = write_palette(directory, rgbs)
+        for colors, max_blends in [(8, 3), (4, 0), (None, 5)]:
+            args = xstitch.default_arguments(color_system_file=palette, blend=True, colors=colors, max_blends=max_blends)
+            job = pipeline.Job(args, input=image_bytes(image), output=io.BytesIO())
+            with contextlib.redirect_stdout(io.StringIO()):
+                for name in ["load", "resize", "colors", "reduce", "convert"]:
+                    job.stage(name, lambda event: None)
+            used = [color for color in job.final_color_tree.selected]
+            blends = [color for color in used if isinstance(color, xstitch.Blend)]
+            if len(blends) > max_blends or (colors is not None and len(used) != colors):
+                print("ERROR: -c {} --max-blends {}: {} colors, {} blends".format(colors, max_blends, len(used), len(blends)))
+                result = False
+    return result
+
+
+def run_tests(*fs):
+    result = 0
+    for f in fs:
+        print("====", f.__name__, "====")
+        if not f():
+            result = 1
+            print(f.__name__, "failed")
+    sys.exit(result)
+
+def main():
+    run_tests(steps_test,
+              run_test,
+              refine_test,
+              cancel_test,
+              passes_test,
+              export_edit_test,
+              max_blends_test)
+
+if __name__ == "__main__":
+    main()
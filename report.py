@@ -1,174 +1,174 @@
 #!/usr/bin/python3
 
-import collections
+import base64
+import io
 import itertools
 import math
 from pathlib import Path
-import tempfile
-import glob
 
 import weasyprint
 from PIL import Image
-from xstitch import timer, scriptdir
+import xstitch
+from symbols import Symbol, create_symbols, glyph
+from layout import plan_pages, create_layout, px
 
-Dimensions = collections.namedtuple("Dimensions", "name, width, height")
-class Dimensions:
-    def __init__(self, name, width, height):
-        self.name = name
-        self.width = width
-        self.height = height
-    def transpose(self):
-        return Dimensions(self.name, self.height, self.width)
+def create(args, image, colors, output):
+    """Writes the pattern as pdf to output, a path or a binary file"""
+    report = Report(args, image, colors)
+    report.write(output)
+    return report
 
-def page_dimensions(page="A4"):
-    """Returns Dimensions(name, width, height) in mm"""
-    D = Dimensions
-    # paper = {d.name:d for d in
-    #          [D("A0", 841, 1189),    D("B0", 1000, 1414),    D("C0", 917, 1297),
-    #           D("A1", 594,  841),    D("B1",  707, 1000),    D("C1", 648,  917),
-    #           D("A2", 420,  594),    D("B2",  500,  707),    D("C2", 458,  648),
-    #           D("A3", 297,  420),    D("B3",  353,  500),    D("C3", 324,  458),
-    #           D("A4", 210,  297),    D("B4",  250,  353),    D("C4", 229,  324),
-    #           D("A5", 148,  210),    D("B5",  176,  250),    D("C5", 162,  229),
-    #           D("A6", 105,  148),    D("B6",  125,  176),    D("C6", 114,  162),
-    #           D("A7",  74,  105),    D("B7",   88,  125),    D("C7",  81,  114),
-    #           D("A8",  52,   74),    D("B8",   62,   88),    D("C8",  57,   81),
-    #           D("A9",  37,   52),    D("B9",   44,   62),    D("C9",  40,   57),
-    #           D("A10", 26,   37),    D("B10",  31,   44),    D("C10", 28,   40),
-    #           D("A", 216, 279), D("B", 279, 432), D("C", 432, 559), D("D", 559, 864), D("E", 864, 1118),
-    #           D("LETTER", 216, 279), D("LEGAL", 216, 356), D("TABLOID", 279, 432), D("LEDGER", 432, 279),
-    #           D("Junior", 127, 203), D("Half", 140, 216), D("Memo", 140, 216)]}
-    paper = {d.name:d for d in
-             [D("A5", 148, 210),
-              D("A4", 210, 297),
-              D("A3", 297, 420),
-              D("B5", 176, 250),
-              D("B4", 250, 353),
-              D("JIS-B5", 182, 257),
-              D("JIS-B4", 257, 364),
-              D("LETTER", 216, 279),
-              D("LEGAL", 216, 356),
-              D("LEDGER", 432, 279)]}
-    page = page.upper().replace("ansi", "").strip()
-    if page != "A4":
-        raise Exception("page not supported")
-    return paper[page]
+class Report:
+    """A rendered pattern that can be edited a stitch at a time
 
-def px(mm):
-    return mm*3.78
+    The front page and every page of the pattern are laid out as separate
+    documents. An edit marks the pages holding the changed stitches and the
+    front page, with the preview and legend, as dirty, and only those are laid
+    out again before the pages are put together into one pdf.
+    """
+    def __init__(self, args, image, colors, symbols=None):
+        self.args = args
+        self.image = image.convert("RGB")
+        self.grid = math.floor(px(args.grid))
+        self.symbol_size = self.grid-4
+        self.border = 1 #px
+        self.plan = plan_pages(args, self.image.size)
+        self.tiles = list(self.plan.tiles())
+        print("layout", self.plan)
 
-def create(args, image, colors):
-    with tempfile.TemporaryDirectory() as directory:
-        timer("report")
-        directory = Path("./").absolute()
-        preview_file = Path(directory, "out.png")
-        html_file = Path(directory, "result.html")
-        filename = Path(directory, "result.pdf")
+        self.colors = {color.rgb(): color for color in sorted(colors, key=lambda c: c.hsv())}
+        self.symbols = dict(symbols) if symbols is not None else create_symbols(self.colors.values())
+        self.counts = {rgb: count for count, rgb in self.image.getcolors(self.image.width * self.image.height)}
+        self.documents = dict()
+        self.timings = dict()
+        self.dirty = set(["front"] + [tile.number for tile in self.tiles])
 
-        page = page_dimensions(args.page).transpose()
-        grid = math.floor(px(args.grid))
-        symbol_size = grid-4
-        border = 1 #px
+    def css(self, rgbs):
+        page = self.plan.page
+        css = css_template.format(width=page.width,
+                                  height=page.height,
+                                  margin=self.args.margin,
+                                  grid=self.grid,
+                                  symbol_size=self.symbol_size,
+                                  border=self.border)
+        return css + create_symbol_css({rgb: self.symbols[rgb] for rgb in rgbs})
 
+    def front(self):
         # if image.width / image.height > page.height / page.width:
         #     preview = image.transpose(Image.ROTATE_270)
         # else:
         #     preview = image
-        preview = image
-        preview = preview.resize((preview.width*10, preview.height*10))
-        preview.save(str(preview_file))
+        preview = self.image
+        preview = preview.resize((preview.width*10, preview.height*10), Image.NEAREST)
+        colors = sorted((self.colors[rgb] for rgb in self.counts), key=lambda c: c.hsv())
+        return page_template.format(css=self.css(self.counts),
+                                    grid=px(self.args.grid),
+                                    preview=data_uri(preview),
+                                    layout=create_layout(self.plan),
+                                    legend=create_legend(colors, self.symbols, self.counts),
+                                    footer="")
 
-        colors = sorted(colors, key=lambda c: c.hsv())
-        symbols = create_symbols(colors)
-        pattern = create_pattern(args, image, symbols, page, grid, border, px(args.margin))
-        legend = create_legend(colors, symbols)
-        icons = "\n".join(load_icons())
+    def page(self, tile):
+        pattern, rgbs = create_page(self.image, self.symbols, tile)
+        return pattern_template.format(css=self.css(rgbs), pattern=pattern)
 
-        css = css_template.format(size=page.name,
-                                  margin=args.margin,
-                                  grid=grid,
-                                  symbol_size=symbol_size,
-                                  border=border)
-        html = page_template.format(css=css,
-                                    grid=px(args.grid),
-                                    preview=str(preview_file),
-                                    layout="",
-                                    pattern=pattern,
-                                    legend=legend,
-                                    footer="",
-                                    icons=icons,
-                                    directory=directory)
+    def edit(self, changes):
+        """Changes stitches, changes maps (x, y) to a Color or the rgb of a color in the pattern"""
+        for (x, y), color in changes.items():
+            rgb = color if isinstance(color, tuple) else color.rgb()
+            if rgb not in self.colors:
+                if isinstance(color, tuple):
+                    raise ValueError("unknown color {}".format(rgb))
+                self.colors[rgb] = color
+            if rgb not in self.symbols:
+                self.symbols[rgb] = Symbol(max((s.index for s in self.symbols.values()), default=-1) + 1)
+            old = self.image.getpixel((x, y))
+            if old == rgb:
+                continue
+            self.image.putpixel((x, y), rgb)
+            self.counts[old] -= 1
+            if self.counts[old] == 0:
+                del self.counts[old]
+            self.counts[rgb] = self.counts.get(rgb, 0) + 1
+            self.dirty.update(tile.number for tile in self.tiles if (x, y) in tile)
+            self.dirty.add("front")
 
-        with html_file.open("w") as file:
-            file.write(html)
-        timer("report")
-        timer("render")
-        d = weasyprint.HTML(string=html).render()
-        print("weasyprint", d.pages[0].width, d.pages[0].height)
-        d.write_pdf(str(filename))
-        # weasyprint.HTML(string=html).write_pdf(str(filename))
-        timer("render")
-        # with svgfile.open("w") as file:
-            # file.write(pattern)
+    def render(self):
+        """Lays out the dirty pages again, returns how many were"""
+        xstitch.timer("render", self.timings)
+        dirty = len(self.dirty)
+        for key in self.dirty:
+            html = self.front() if key == "front" else self.page(self.tiles[key - 1])
+            self.documents[key] = weasyprint.HTML(string=html).render()
+        self.dirty.clear()
+        xstitch.timer("render", self.timings)
+        return dirty
 
-def create_symbols(colors):
-    alphabet = """abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZæøåÆØÅ1234567890,.<>`~!@#$%^&*()λπ=+¡ºª¢€ħðþ‘’×¹²³£¥ĦÐÞ“”÷[]{}«»‹›'"|õ/?-_–äÄ"""
-    symbols = itertools.cycle(alphabet)
-    return {(c.red, c.green, c.blue):l for c,l in zip(colors, symbols)}
+    def write(self, output):
+        """Writes the whole pdf to output, a path or a binary file"""
+        self.render()
+        documents = [self.documents["front"]] + [self.documents[tile.number] for tile in self.tiles]
+        pages = [page for document in documents for page in document.pages]
+        # Streamed straight to the file or handle, no intermediate files
+        documents[0].copy(pages).write_pdf(str(output) if isinstance(output, Path) else output)
 
-def create_pattern(args, image, symbols, page, grid, border, margin):
-    result = []
-
-    page_width = math.floor((px(page.width) - margin*2) / (grid + border))
-    page_height = math.floor((px(page.height) - margin*2) / (grid + border))
-    print("px", page_width, page_height)
-    print(px(page.width) - margin*2, px(page.height) - margin*2)
+def data_uri(image):
+    buffer = io.BytesIO()
+    image.save(buffer, "PNG")
+    return "data:image/png;base64," + base64.b64encode(buffer.getvalue()).decode("ascii")
 
-    page = 0
-    for pagey in range(0, image.height, page_height):
-        for pagex in range(0, image.width, page_width):
-            page += 1
-            result.append('<p class="pagebreak"></p>')
-            result.append("""<table class="pattern">""")
-            for y in range(pagey, min(pagey+page_height, image.height)):
-                result.append("<tr>")
-                for x in range(pagex, min(pagex+page_width, image.width)):
-                    pixel = image.getpixel((x, y))[:3]
-                    symbol = symbols[pixel]
-                    result.append('<td style="background-color:rgb{}; color:{};">'.format(pixel, "#ffffff" if is_dark(pixel) else "#000000"))
-                    result.append(symbol)
-                    # result.append('<div class="content"></div>')
-                    result.append("</td>")
-                result.append("</tr>")
-            result.append("</table>")
-            result.append('<div class="page">{}</div>'.format(page))
+def create_symbol_css(symbols):
+    # Every glyph is defined once, cells and legend only refer to its class
+    result = []
+    for rgb, symbol in symbols.items():
+        foreground = "#ffffff" if is_dark(rgb) else "#000000"
+        result.append('.{} {{ background-color: rgb{}; background-image: url("{}"); }}'.format(
+            symbol.id, rgb, glyph(symbol.index, foreground, "rgb{}".format(rgb))))
     return "\n".join(result)
 
+def create_page(image, symbols, tile):
+    """Returns the pattern of one page and the colors on it"""
+    result = []
+    rgbs = set()
+    result.append("""<table class="pattern">""")
+    for y in range(tile.top, tile.bottom):
+        result.append("<tr>")
+        for x in range(tile.left, tile.right):
+            pixel = image.getpixel((x, y))[:3]
+            rgbs.add(pixel)
+            result.append('<td class="{}"></td>'.format(symbols[pixel].id))
+        result.append("</tr>")
+    result.append("</table>")
+    result.append('<div class="page">{} ({}-{}, {}-{})</div>'.format(
+        tile.number, tile.left + 1, tile.right, tile.top + 1, tile.bottom))
+    return "\n".join(result), rgbs
+
 def is_dark(color):
     return color[0]+color[1]+color[2] < 128 * 3
 
-def create_legend(colors, symbols):
+def create_legend(colors, symbols, counts=None):
     # redest = min(colors, lambda c: math.sqrt((255-c.red)**2))
     result = []
     result.append('<table class="legend">')
     for color in colors:
         result.append("<tr>")
-        row = ("<td>{}</td>".format(x) for x in (symbols[color.rgb()], color.name, color.description))
+        result.append('<td class="symbol {}"></td>'.format(symbols[color.rgb()].id))
+        row = ("<td>{}</td>".format(x) for x in (color.name, color.description))
+        if counts is not None:
+            row = itertools.chain(row, ["<td>{}</td>".format(counts.get(color.rgb(), 0))])
         result.append("".join(row))
-        result.append('<td style="background-color:rgb{}; width:10mm;"></td>'.format(str(color.rgb())))
+        threads = getattr(color, "threads", None)
+        if threads:
+            # A blend shows the two threads it is made from
+            result.append('<td style="width:10mm;">{}</td>'.format("".join(
+                '<div style="background-color:rgb{}; width:5mm; height:100%; float:left;">&nbsp;</div>'.format(str(thread.rgb()))
+                for thread in threads)))
+        else:
+            result.append('<td style="background-color:rgb{}; width:10mm;"></td>'.format(str(color.rgb())))
         result.append("</tr>")
     result.append('</table>')
     return "\n".join(result)
 
-def load_icons():
-    p = Path(scriptdir, "icons", "*")
-    result = []
-    for filename in glob.glob(str(p)):
-        with open(filename) as f:
-            result.append('<div class="symbol">{}</div>'.format(f.read()))
-    return result
-
-
 page_template = """\
 <!DOCTYPE html>
 <html>
@@ -179,23 +179,32 @@ page_template = """\
   </head>
   <body>
     <div style="width:100%;background-color:#0000ff">XStitch</div>
-    <img src="file://{preview}" class="preview">
+    <img src="{preview}" class="preview">
     <div style="width:{grid}px; height:{grid}px;background-color: #ff00ff"></div>
-    <div style="background-color:#00ff00; height:50px;">
-      {icons}
-    </div>
     {legend}
     {layout}
     {footer}
+  </body>
+</html>
+"""
+
+pattern_template = """\
+<!DOCTYPE html>
+<html>
+  <head>
+    <style>
+    {css}
+    </style>
+  </head>
+  <body>
     {pattern}
-    <p class="pagebreak"></p>
   </body>
 </html>
 """
 
 css_template = """\
 @page {{
-  size: {size} landscape;
+  size: {width}mm {height}mm;
   bleed: 0mm;
   margin: {margin}mm;
   border: 0mm;
@@ -250,12 +259,25 @@ body {{
   top: 5px;
   left: -15px;
 }}
+.layout {{
+  border-collapse: collapse;
+  font-size: 8pt;
+}}
+.layout td {{
+  border: {border}px solid black;
+  text-align: center;
+}}
 .pagebreak {{
   page-break-after: always;
 }}
 
+.pattern td, .symbol {{
+  background-repeat: no-repeat;
+  background-position: center;
+  background-size: {symbol_size}px {symbol_size}px;
+}}
 .symbol {{
-  width: {symbol_size}px;
-  height: {symbol_size}px;
+  width: {grid}px;
+  height: {grid}px;
 }}
 """
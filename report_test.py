@@ -0,0 +1,80 @@
+#!/usr/bin/python3
+
+import contextlib
+import io
+import sys
+from PIL import Image
+
+import xstitch
+import report
+
+black = xstitch.Color(0, 0, 0, "310", "Black")
+white = xstitch.Color(255, 255, 255, "B5200", "Snow White")
+red = xstitch.Color(199, 43, 59, "321", "Red")
+
+def create_report(size, **arguments):
+    image = Image.new("RGB", size, white.rgb())
+    image.putpixel((0, 0), black.rgb())
+    args = xstitch.default_arguments(**arguments)
+    with contextlib.redirect_stdout(io.StringIO()):
+        result = report.Report(args, image, [black, white])
+    # As if rendered
+    result.dirty.clear()
+    return result
+
+def edit_test():
+    result = True
+    def check(name, value, expected):
+        nonlocal result
+        if value != expected:
+            print("ERROR: {}: {} != {}".format(name, value, expected))
+            result = False
+    pattern = create_report((200, 200), page="A5", overlap=4)
+    tiles = pattern.tiles
+    check("pages", len(tiles) > 1, True)
+    # A stitch in the overlap of the first two pages
+    x = tiles[1].left
+    shared = set(tile.number for tile in tiles if (x, 0) in tile)
+    check("shared", len(shared), 2)
+    pattern.edit({(x, 0): black})
+    check("dirty overlap", pattern.dirty, shared | {"front"})
+    check("counts", pattern.counts, {black.rgb(): 2, white.rgb(): 200 * 200 - 2})
+
+    pattern.dirty.clear()
+    pattern.edit({(x, 0): black.rgb()})
+    check("unchanged", pattern.dirty, set())
+
+    last = tiles[-1]
+    symbols = set(symbol.index for symbol in pattern.symbols.values())
+    pattern.edit({(last.right - 1, last.bottom - 1): red, (0, 0): white})
+    check("dirty", pattern.dirty, {tile.number for tile in tiles
+                                   if (last.right - 1, last.bottom - 1) in tile or (0, 0) in tile} | {"front"})
+    check("new symbol", pattern.symbols[red.rgb()].index, max(symbols) + 1)
+    check("counts after", pattern.counts, {black.rgb(): 1, red.rgb(): 1, white.rgb(): 200 * 200 - 2})
+    check("image", pattern.image.getpixel((last.right - 1, last.bottom - 1)), red.rgb())
+
+    pattern.edit({(x, 0): white})
+    check("unused color", black.rgb() in pattern.counts, False)
+    try:
+        pattern.edit({(1, 1): (1, 2, 3)})
+        print("ERROR: unknown rgb was accepted")
+        result = False
+    except ValueError:
+        pass
+    return result
+
+
+def run_tests(*fs):
+    result = 0
+    for f in fs:
+        print("====", f.__name__, "====")
+        if not f():
+            result = 1
+            print(f.__name__, "failed")
+    sys.exit(result)
+
+def main():
+    run_tests(edit_test)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,78 @@
+#!/usr/bin/python3
+
+import base64
+import functools
+
+# Shapes drawn in a 10x10 box, outlined or filled, most distinct first
+shapes = [
+    ("circle", '<circle cx="5" cy="5" r="3.8"/>'),
+    ("square", '<rect x="1.5" y="1.5" width="7" height="7"/>'),
+    ("triangle", '<polygon points="5,1 9,8.5 1,8.5"/>'),
+    ("diamond", '<polygon points="5,0.8 9.2,5 5,9.2 0.8,5"/>'),
+    ("plus", '<polygon points="3.8,1 6.2,1 6.2,3.8 9,3.8 9,6.2 6.2,6.2 6.2,9 3.8,9 3.8,6.2 1,6.2 1,3.8 3.8,3.8"/>'),
+    ("down", '<polygon points="1,1.5 9,1.5 5,9"/>'),
+    ("star", '<polygon points="5,0.6 6.2,3.6 9.4,3.7 6.9,5.8 7.8,9 5,7.2 2.2,9 3.1,5.8 0.6,3.7 3.8,3.6"/>'),
+    ("hexagon", '<polygon points="3,1.2 7,1.2 9,5 7,8.8 3,8.8 1,5"/>'),
+    ("left", '<polygon points="1.5,5 9,1 9,9"/>'),
+    ("right", '<polygon points="8.5,5 1,1 1,9"/>'),
+    ("heart", '<path d="M5,9 L1.2,5 A2.2,2.2 0 0 1 5,2.6 A2.2,2.2 0 0 1 8.8,5 Z"/>'),
+    ("cross", '<polygon points="1,2.6 2.6,1 5,3.4 7.4,1 9,2.6 6.6,5 9,7.4 7.4,9 5,6.6 2.6,9 1,7.4 3.4,5"/>'),
+    ("bar", '<rect x="1" y="3.5" width="8" height="3"/>'),
+    ("pillar", '<rect x="3.5" y="1" width="3" height="8"/>'),
+]
+styles = ["outline", "filled"]
+# Marks put on top of a shape once every plain shape is taken
+marks = "123456789ABCDEFGHJKLMNPRSTUVWXYZ"
+
+class Symbol:
+    def __init__(self, index):
+        self.index = index
+        plain = len(shapes) * len(styles)
+        if index < plain:
+            kind, mark = index, None
+        else:
+            kind, mark = (index - plain) % plain, (index - plain) // plain
+            mark = marks[mark] if mark < len(marks) else str(mark - len(marks) + 10)
+        self.shape, self.path = shapes[kind % len(shapes)]
+        self.style = styles[kind // len(shapes)]
+        self.mark = mark
+
+    @property
+    def id(self):
+        return "s{}".format(self.index)
+
+    @property
+    def name(self):
+        return " ".join(x for x in (self.style, self.shape, self.mark) if x)
+
+    def svg(self, foreground, background):
+        if self.style == "filled":
+            shape = '<g fill="{}" stroke="none">{}</g>'.format(foreground, self.path)
+            text = background
+        else:
+            shape = '<g fill="none" stroke="{}" stroke-width="0.9">{}</g>'.format(foreground, self.path)
+            text = foreground
+        mark = ""
+        if self.mark:
+            mark = ('<text x="5" y="6.9" font-family="sans-serif" font-weight="bold" font-size="{}" '
+                    'text-anchor="middle" fill="{}">{}</text>').format(5.5 if len(self.mark) == 1 else 4, text, self.mark)
+        return ('<svg xmlns="http://www.w3.org/2000/svg" viewBox="0 0 10 10">{}{}</svg>'
+                .format(shape, mark))
+
+    def __repr__(self):
+        return "Symbol({}, {})".format(self.index, self.name)
+
+def symbol_set(count):
+    """Returns count different symbols, plain shapes before marked ones"""
+    return [Symbol(i) for i in range(count)]
+
+def create_symbols(colors):
+    """Returns a different symbol for every color, keyed by rgb"""
+    rgbs = list(dict.fromkeys(color.rgb() for color in colors))
+    return dict(zip(rgbs, symbol_set(len(rgbs))))
+
+@functools.lru_cache(maxsize=None)
+def glyph(index, foreground, background):
+    """Returns the symbol as a data uri, made once per symbol and color"""
+    svg = Symbol(index).svg(foreground, background)
+    return "data:image/svg+xml;base64," + base64.b64encode(svg.encode("utf-8")).decode("ascii")
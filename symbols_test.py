@@ -0,0 +1,74 @@
+#!/usr/bin/python3
+
+import sys
+import xml.etree.ElementTree as ElementTree
+
+import xstitch
+import report
+from symbols import Symbol, symbol_set, create_symbols, shapes, styles, marks
+
+def symbol_set_test():
+    plain = len(shapes) * len(styles)
+    # Plain only, the first marked, every mark used, past the marks
+    for count in [plain, plain + 1, plain * (len(marks) + 1), 1000]:
+        symbols = symbol_set(count)
+        if len(symbols) != count:
+            print("ERROR: {} symbols for {}".format(len(symbols), count))
+            return False
+        for attribute in ["id", "name"]:
+            values = [getattr(symbol, attribute) for symbol in symbols]
+            if len(set(values)) != count:
+                print("ERROR: {} symbols share a {}".format(count - len(set(values)), attribute))
+                return False
+    if any(symbol.mark for symbol in symbol_set(plain)) or not Symbol(plain).mark:
+        print("ERROR: marks used before every plain shape")
+        return False
+    for symbol in symbol_set(1000)[::37]:
+        try:
+            ElementTree.fromstring(symbol.svg("#000000", "#ffffff"))
+        except ElementTree.ParseError as error:
+            print("ERROR: {}: {}".format(symbol, error))
+            return False
+    return True
+
+def create_symbols_test():
+    red = xstitch.Color(199, 43, 59, "321", "Red")
+    colors = [red, xstitch.Color(0, 0, 0, "310", "Black"), xstitch.Color(199, 43, 59, "666", "Bright Red"), red]
+    symbols = create_symbols(colors)
+    if sorted(symbols) != sorted([(199, 43, 59), (0, 0, 0)]):
+        print("ERROR: symbols for {}".format(sorted(symbols)))
+        return False
+    if sorted(symbol.index for symbol in symbols.values()) != [0, 1]:
+        print("ERROR: symbols {}".format(symbols))
+        return False
+    return True
+
+def symbol_css_test():
+    symbols = {(i, 255 - i, i // 2): symbol for i, symbol in enumerate(symbol_set(40))}
+    css = report.create_symbol_css(symbols).splitlines()
+    if len(css) != len(symbols):
+        print("ERROR: {} rules for {} symbols".format(len(css), len(symbols)))
+        return False
+    for rule, (rgb, symbol) in zip(css, symbols.items()):
+        if not rule.startswith(".{} ".format(symbol.id)) or "rgb{}".format(rgb) not in rule:
+            print("ERROR: {} for {} {}".format(rule[:60], symbol, rgb))
+            return False
+    return True
+
+
+def run_tests(*fs):
+    result = 0
+    for f in fs:
+        print("====", f.__name__, "====")
+        if not f():
+            result = 1
+            print(f.__name__, "failed")
+    sys.exit(result)
+
+def main():
+    run_tests(symbol_set_test,
+              create_symbols_test,
+              symbol_css_test)
+
+if __name__ == "__main__":
+    main()
@@ -1,8 +1,7 @@
 #!/usr/bin/python3
 
 import argparse
-import csv
-import glob
+import contextlib
 import re
 import os
 import pathlib
@@ -10,99 +9,297 @@ import sys
 import time
 import math
 import itertools
-from PIL import Image
+from PIL import Image, ImageDraw
 
-from kdtree import KDTree, NaiveNeighbour
-from kmeans import kmeans
-import report
+from kdtree import KDTree, NaiveNeighbour, GridNeighbour
+from kmeans import kmeans, sweep
+from palette import PaletteRegistry, rgb_to_hsv, rgb_to_lab
+from layout import papers
+import pipeline
 
 scriptdir = os.path.dirname(os.path.abspath(sys.argv[0]))
-color_system_format = ["name", "description", "red", "green", "blue", "hex"]
 
 axises = [lambda c: c.red, lambda c: c.green, lambda c: c.blue]
 
 class Color:
-    def __init__(self, red, green, blue, name=None, description=None, hex=None):
+    def __init__(self, red, green, blue, name=None, description=None, hex=None, hsv=None, lab=None):
         self.red = int(red)
         self.green = int(green)
         self.blue = int(blue)
         self.name = name
         self.description = description
         self.hex = hex
+        self._hsv = hsv
+        self._lab = lab
     def rgb(self):
         return (self.red, self.green, self.blue)
     def hsv(self):
-        r = self.red/255.0
-        g = self.green/255.0
-        b = self.blue/255.0
-        m = min(r,g,b)
-        M = max(r,g,b)
-        v = M
-        delta = M - m
-        if v == 0:
-            return (0, 0, v)
-        else:
-            s = delta / M
-
-        if delta == 0:
-            h = 0
-        if M == r:
-            h = ((g - b)/delta)
-        if M == g:
-            h = (b-r)/delta + 2
-        if M == b:
-            h = (r-g)/delta + 4
-        h *= 60
-        if h < 0:
-            h += 360
-        return (h, s, v)
+        if self._hsv is None:
+            self._hsv = rgb_to_hsv(self.red, self.green, self.blue)
+        return self._hsv
+    def lab(self):
+        if self._lab is None:
+            self._lab = rgb_to_lab(self.red, self.green, self.blue)
+        return self._lab
 
     def __repr__(self):
         return "Color({})".format(", ".join(str(x) for x in (self.red, self.green, self.blue, self.name) if x is not None))
 
-def parse_arguments():
-    color_systems = [x[len("color-systems/"):-4] for x in glob.glob("color-systems/*.csv")]
+class Blend(Color):
+    """Two strands of different threads stitched in the same cross"""
+    def __init__(self, first, second):
+        super().__init__(round((first.red + second.red) / 2),
+                         round((first.green + second.green) / 2),
+                         round((first.blue + second.blue) / 2),
+                         "{}+{}".format(first.name, second.name),
+                         "{} + {}".format(first.description, second.description))
+        self.threads = (first, second)
+
+# Shared by the command line, the tests and anything else importing xstitch
+palettes = PaletteRegistry(Color, axises, "rgb")
+
+def color_counts(text):
+    """Parses -c, a single count gives an int and a list or range a list"""
+    result = []
+    for part in text.split(","):
+        match = re.match(r"^\s*(\d+)\s*(?:-\s*(\d+)\s*(?::\s*(\d+)\s*)?)?$", part)
+        if match is None:
+            raise argparse.ArgumentTypeError("invalid color count '{}'".format(part))
+        start, end, step = match.groups()
+        if end is None:
+            counts = [int(start)]
+        else:
+            if int(step or 1) < 1:
+                raise argparse.ArgumentTypeError("invalid step in '{}'".format(part))
+            counts = range(int(start), int(end) + 1, int(step or 1))
+        if not counts:
+            raise argparse.ArgumentTypeError("empty color range '{}'".format(part))
+        if min(counts) < 1:
+            raise argparse.ArgumentTypeError("color counts must be at least 1 in '{}'".format(part))
+        result += counts
+    if len(result) == 1 and "-" not in text and "," not in text:
+        return result[0]
+    return sorted(set(result))
+
+def non_negative(text):
+    """Checks an argument is a whole number, 0 or more"""
+    try:
+        value = int(text)
+    except ValueError:
+        raise argparse.ArgumentTypeError("invalid number '{}'".format(text))
+    if value < 0:
+        raise argparse.ArgumentTypeError("must be 0 or more, not {}".format(value))
+    return value
+
+def page_list(text):
+    """Checks -p names pages that exist, the text itself is kept for planning"""
+    try:
+        papers(text)
+    except ValueError as error:
+        raise argparse.ArgumentTypeError(str(error))
+    return text
+
+def argument_parser():
+    color_systems = palettes.available()
     parser = argparse.ArgumentParser(description="Create a cross-stitch embroidery from an image.")
     parser.add_argument("input", help="Input file to read from, eg 'embroidery.png', use '-' to read from stdin.")
-    parser.add_argument("-o", "--output", type=argparse.FileType("w"), help="Output file to write to, eg 'embroidery.pdf', use '-' to print to stdout. (default: use the input filename)")
+    parser.add_argument("-o", "--output", type=argparse.FileType("wb"), help="Output file to write to, eg 'embroidery.pdf', use '-' to print to stdout. (default: use the input filename)")
     parser.add_argument("-s", "--size", help="Size of final embroidery in crosses. Given as width*height, eg 400*300. (default: use image dimensions)", default=None)
-    parser.add_argument("-p", "--page", default="A4", help="Page type type or page dimensions for the output")
-    parser.add_argument("-c", "--colors", type=int, help="Maximum number of different colors to use")
+    parser.add_argument("-p", "--page", type=page_list, default="A4", help="Page type or page dimensions in mm, eg 'A4' or '210x297'. Several can be given separated by commas, or 'auto' for every supported page type, the one needing the fewest pages is used. (default: A4)")
+    parser.add_argument("--overlap", type=int, default=0, help="Number of rows and columns repeated on neighbouring pages (default: 0)")
+    parser.add_argument("-c", "--colors", type=color_counts, help="Maximum number of different colors to use. A list such as 10,15,20 or a range such as 10-30 or 10-30:5 makes a contact sheet comparing them instead of a pattern.")
     parser.add_argument("-b", "--brightness", "--brightness-cutoff", help="Brightness value to ignore, no stitches will be put at pixels brighter than this value, can either be one or three integers [0-255].")
     parser.add_argument("-m", "--margin", type=float, default=10.0, help="Width of margin of paper, in mm. (default: 10mm)")
     parser.add_argument("-g", "--grid", "--grid-size", type=float, default=3.0, help="Grid size of the pattern, in mm. (default: 3.0mm)")
-    parser.add_argument("--method", default="tree", choices=["naive", "tree"], help="Algorithm to use")
+    parser.add_argument("-f", "--format", choices=["pdf", "xsp"], default=None, help="Write a printable pdf, or an xsp pattern file holding the stitches, colors, symbols and page plan for other tools to render from. (default: xsp when the output ends in '.xsp', otherwise pdf)")
+    parser.add_argument("--draft", action="store_true", help="Only write a quick, rough png preview from a downscaled copy of the image")
+    parser.add_argument("--method", default="tree", choices=["naive", "tree", "approx"], help="Algorithm to use, approx is fastest but may pick a slightly worse color")
+    parser.add_argument("--blend", action="store_true", help="Also use crosses made from two strands of different threads")
+    parser.add_argument("--max-blends", type=non_negative, default=None, help="Maximum number of different blended threads to use (default: no limit)")
+    parser.add_argument("--blend-distance", type=float, default=None, help="Only blend threads at most this far apart in rgb (default: blend any two threads)")
     group = parser.add_mutually_exclusive_group()
     group.add_argument("--color-system", choices=color_systems, help="The yarn color system to use", default="DMC")
     group.add_argument("--color-system-file", help="The yarn color system file to use")
-    args = parser.parse_args()
+    return parser
+
+def parse_arguments(argv=None):
+    return argument_parser().parse_args(argv)
+
+def default_arguments(input="-", **overrides):
+    """Arguments as the command line would give them, for running without one"""
+    args = argument_parser().parse_args([input])
+    for name, value in overrides.items():
+        if not hasattr(args, name):
+            raise TypeError("unknown argument '{}'".format(name))
+        setattr(args, name, value)
     return args
 
-def load_colors(args):
+def load_palette(args):
     if args.color_system_file:
         filename = pathlib.Path(args.color_system_file)
     else:
-        filename = pathlib.Path(scriptdir, "color-systems", args.color_system + ".csv")
-    try:
-        with filename.open(newline='') as csvfile:
-            reader = csv.DictReader(csvfile, fieldnames=color_system_format)
-            colors = [Color(row["red"], row["green"], row["blue"], row["name"], row["description"], row["hex"])
-                      for row in reader]
-            return colors
-    except FileNotFoundError:
-        print("ERROR: color system not found '{}'".format(filename))
-        sys.exit(1)
-
-def color_convert(image, colortree, colors=None):
-    image = image.copy()
-    duration = 0
-    for i, pixel in enumerate(image.getdata()):
-        y = i // image.width
-        x = i % image.width
-        pixel_color = Color(*pixel[:3])
-        matched_color = colortree.nearest_neighbour(pixel_color)
-        new_color = (matched_color.red, matched_color.green, matched_color.blue)
-        image.putpixel((x, y), new_color)
+        filename = palettes.path(args.color_system)
+    return palettes.load(filename)
+
+def load_colors(args):
+    return load_palette(args).colors
+
+def blend_colors(colors, max_distance=None):
+    """Returns a Blend for every pair of colors giving a color not already present"""
+    colors = list(colors)
+    seen = set(color.rgb() for color in colors)
+    result = []
+    for i, first in enumerate(colors):
+        for second in colors[i + 1:]:
+            if max_distance is not None and math.sqrt(sum((axis(first) - axis(second))**2 for axis in axises)) > max_distance:
+                continue
+            blend = Blend(first, second)
+            if blend.rgb() not in seen:
+                seen.add(blend.rgb())
+                result.append(blend)
+    return result
+
+def blend_tree(palette, max_distance=None):
+    key = ("blend", max_distance)
+    if key not in palette.derived:
+        palette.derived[key] = KDTree(palette.colors + blend_colors(palette.colors, max_distance), axises)
+    return palette.derived[key].copy()
+
+def limit_blends(colortree, colors, converted, max_blends):
+    """Returns a tree of colortree keeping at most max_blends blends, the most used in converted
+
+    Every other blend converted uses is replaced by the nearest of colors, the
+    plain threads, not already in the tree, so as many colors are left as
+    before when colors has enough threads.
+    """
+    blends = [color for color in colortree.selected if isinstance(color, Blend)]
+    if len(blends) <= max_blends:
+        return colortree
+    counts = {color: count for count, color in converted.getcolors(converted.width * converted.height)}
+    blends.sort(key=lambda color: counts.get(color.rgb(), 0), reverse=True)
+    kept = set(blends[:max_blends])
+    result = dict()
+    for color in colortree.in_order():
+        if not isinstance(color, Blend) or color in kept:
+            result.setdefault(color.rgb(), color)
+    candidates = [color for color in colors if color.rgb() not in result]
+    for blend in blends[max_blends:]:
+        if not candidates:
+            break
+        nearest = min(candidates, key=lambda color: sum((axis(color) - axis(blend))**2 for axis in axises))
+        candidates.remove(nearest)
+        result[nearest.rgb()] = nearest
+    return type(colortree)(result.values(), axises)
+
+def approx_tree(palette, blend=False, max_distance=None):
+    key = ("approx", blend, max_distance)
+    if key not in palette.derived:
+        colors = palette.colors
+        if blend:
+            colors = colors + blend_colors(colors, max_distance)
+        palette.derived[key] = GridNeighbour(colors, axises)
+    return palette.derived[key].copy()
+
+def color_tree(args, palette):
+    if args.method == "approx":
+        tree = approx_tree(palette, args.blend, args.blend_distance)
+        print("Approximate matching, at most {:.1f} further than the nearest color".format(tree.max_error))
+        return tree
+    elif args.method == "tree" and args.blend:
+        return blend_tree(palette, args.blend_distance)
+    elif args.method == "tree":
+        return palette.tree()
+    elif args.method == "naive" and args.blend:
+        return NaiveNeighbour(palette.colors + blend_colors(palette.colors, args.blend_distance), axises)
+    elif args.method == "naive":
+        return NaiveNeighbour(palette.colors, axises)
+    raise ValueError("Invalid method selected '{}'".format(args.method))
+
+def resize(image, size):
+    """Resizes to a size given as width*height, eg '400*300'"""
+    match = re.match("(\d+)[*+,.-xX ](\d+)", size)
+    if match is None:
+        raise ValueError("Invalid size '{}'".format(size))
+    return image.resize([int(x) for x in match.groups()])
+
+def reduce_colors(image, colortree, count, progress=None, means=None):
+    """Chooses at most count colors of colortree by kmeans over the image
+
+    Returns a tree of the colors and the means they were chosen from, kmeans
+    starts from means when given.
+    """
+    means = kmeans(count, get_pixels(image), axises, progress=progress, means=means)
+    final_colors = set(colortree.nearest_neighbour(Color(*mean)) for mean in means)
+    if len(final_colors) != count:
+        print("Warning: You wanted {} but xstitch reduced to {} colors".format(count, len(final_colors)))
+    return KDTree(final_colors, axises), means
+
+class Reduction:
+    def __init__(self, count, colors, converted, error):
+        self.count = count
+        self.colors = colors
+        self.converted = converted
+        self.error = error
+
+    def __repr__(self):
+        return "Reduction({}, {} colors, mean error {:.2f})".format(self.count, len(self.colors), self.error)
+
+def color_sweep(image, colortree, counts, progress=None):
+    """Reduces the image to every number of colors in counts in one go
+
+    kmeans for every count continues from the one before, over the distinct
+    colors of the image. Every Reduction has the mean Delta E (CIE76) of its
+    stitches against the image.
+    """
+    image = image.convert("RGB")
+    pixels = list(image.getdata())
+    histogram = count_unique(pixels)
+    unique = [Color(*pixel) for pixel in histogram]
+    total = sum(histogram.values())
+    result = []
+    for count, means in sweep(counts, histogram, progress).items():
+        final_colors = set(colortree.nearest_neighbours(Color(*mean) for mean in means))
+        final_color_tree = KDTree(final_colors, axises)
+        matches = final_color_tree.nearest_neighbours(unique)
+        error = 0
+        for color, match in zip(unique, matches):
+            error += histogram[color.rgb()] * math.sqrt(sum((a - b)**2 for a, b in zip(color.lab(), match.lab())))
+        mapping = {color.rgb(): match.rgb() for color, match in zip(unique, matches)}
+        converted = Image.new("RGB", image.size)
+        converted.putdata([mapping[pixel] for pixel in pixels])
+        result.append(Reduction(count, final_color_tree.selected, converted, error / max(total, 1)))
+    return result
+
+def contact_sheet(reductions, size=256):
+    """Returns the reductions side by side, each at most size pixels and labelled"""
+    columns = math.ceil(math.sqrt(len(reductions))) or 1
+    rows = math.ceil(len(reductions) / columns)
+    label = 14
+    sheet = Image.new("RGB", (columns * size, rows * (size + label)), (255, 255, 255))
+    draw = ImageDraw.Draw(sheet)
+    for i, reduction in enumerate(reductions):
+        x = (i % columns) * size
+        y = (i // columns) * (size + label)
+        scale = size / max(reduction.converted.size)
+        preview = reduction.converted.resize((max(1, round(reduction.converted.width * scale)),
+                                              max(1, round(reduction.converted.height * scale))), Image.NEAREST)
+        sheet.paste(preview, (x, y))
+        draw.text((x + 2, y + size), "{} colors, mean dE {:.1f}".format(len(reduction.colors), reduction.error), fill=(0, 0, 0))
+    return sheet
+
+def color_convert(image, colortree, colors=None, progress=None):
+    image = image.convert("RGB")
+    pixels = list(image.getdata())
+    unique = list(set(pixels))
+    mapping = dict()
+    chunk = 4096
+    for start in range(0, len(unique), chunk):
+        if progress is not None:
+            progress(start, len(unique))
+        part = unique[start:start + chunk]
+        matches = colortree.nearest_neighbours(Color(*pixel) for pixel in part)
+        mapping.update((pixel, match.rgb()) for pixel, match in zip(part, matches))
+    image.putdata([mapping[pixel] for pixel in pixels])
     return image
 
 def get_pixels(image):
@@ -122,75 +319,53 @@ def count_unique(items):
 
 def main():
     args = parse_arguments()
-
-    print("================ LOAD:    ================")
-    try:
-        image = Image.open(args.input)
-    except FileNotFoundError:
-        print("ERROR: file not found '{}'".format(args.input))
-        sys.exit(1)
-    except IOError:
-        print("ERROR: File is not a readable image '{}'".format(args.input))
-        sys.exit(1)
-
-    print("================ RESIZE:  ================")
-    if args.size:
-        match = re.match("(\d+)[*+,.-xX ](\d+)", args.size)
-        size = [int(x) for x in match.groups()]
-        image = image.resize(size)
-    image.save("out.scaled.png")
-
-    print("================ COLORS:  ================")
-    colors = load_colors(args)
-
-    if args.method == "tree":
-        color_tree = KDTree(colors, axises)
-    elif args.method == "naive":
-        color_tree = NaiveNeighbour(colors, axises)
-    else:
-        print("ERROR: Invalid method selected")
-        sys.exit(1)
-
-    print("================ REDUCE:  ================")
-    if args.colors is not None:
-        timer("kmeans")
-        colors = get_pixels(image)
-        means = kmeans(args.colors, colors, axises)
-        final_colors = set(color_tree.nearest_neighbour(Color(*mean)) for mean in means)
-        if len(final_colors) != args.colors:
-            print("Warning: You wanted {} but xstitch reduced to {} colors".format(args.colors, len(final_colors)))
-            # sys.exit(1)
-        final_color_tree = KDTree(final_colors, axises)
-        reduced = color_convert(image, final_color_tree)
-        if len(final_color_tree.selected) != args.colors:
-            print("Warning: Fewer than the wanted colors ended up being used ({} != {})".format(len(final_color_tree.selected), args.colors))
-        timer("true pixels")
-        timer("kmeans")
+    if args.output:
+        output = args.output
+    elif args.input == "-":
+        output = sys.stdout.buffer
     else:
-        final_color_tree = color_tree
-
-    print("================ CONVERT: ================")
-    timer("convert")
-    converted = color_convert(image, final_color_tree);
-    timer("convert")
-
-    print("================ OUTPUT:  ================")
-    report.create(args, converted, final_color_tree.selected)
+        suffix = ".xsp" if args.format == "xsp" else ".pdf"
+        if args.draft:
+            suffix = ".draft.png"
+        elif isinstance(args.colors, list):
+            suffix = ".sweep.png"
+        output = str(pathlib.Path(args.input).with_suffix(suffix))
+    if args.format is None:
+        name = getattr(output, "name", output)
+        args.format = "xsp" if isinstance(name, str) and name.endswith(".xsp") else "pdf"
+
+    job = pipeline.Job(args, output=output)
+    # Keep the pdf alone on stdout when it is written there
+    with contextlib.redirect_stdout(sys.stderr if output is sys.stdout.buffer else sys.stdout):
+        timer("main")
+        try:
+            if args.draft:
+                preview = next(job.passes())
+                preview.image.save(output, "PNG")
+            else:
+                for event in job.steps():
+                    if event.done == 0:
+                        print("================ {:8} ================".format(event.stage.upper() + ":"))
+        except pipeline.JobError as error:
+            print("ERROR: {}".format(error))
+            sys.exit(1)
+        timer("main")
+    if hasattr(output, "flush"):
+        output.flush()
 
 timemap = dict()
-def timer(name):
-    start = timemap.pop(name, None)
+def timer(name, timings=timemap):
+    """Starts or stops the named timer, timings keeps them apart from other jobs'"""
+    start = timings.pop(name, None)
     if start is None:
-        timemap[name] = time.time()
+        timings[name] = time.time()
     else:
         duration = time.time() - start
-        timemap[name] = None
+        timings[name] = None
         print("TIME ({}): {}".format(name, duration))
 
 if __name__ == "__main__":
-    timer("main")
     main()
-    timer("main")
 
 
 
@@ -0,0 +1,63 @@
+#!/usr/bin/python3
+
+import argparse
+import contextlib
+import io
+import sys
+
+import xstitch
+
+def color_counts_test():
+    cases = [("10", 10),
+             ("10,15,20", [10, 15, 20]),
+             ("20,10,10", [10, 20]),
+             ("10-14", [10, 11, 12, 13, 14]),
+             ("10-30:10", [10, 20, 30]),
+             ("5, 8-9", [5, 8, 9]),
+             ("12-12", [12])]
+    result = True
+    for text, expected in cases:
+        counts = xstitch.color_counts(text)
+        if counts != expected:
+            print("ERROR: {} -> {} != {}".format(text, counts, expected))
+            result = False
+    for text in ["", "ten", "10-5", "0", "0-3", "5-10:0", "10,"]:
+        try:
+            counts = xstitch.color_counts(text)
+        except argparse.ArgumentTypeError:
+            continue
+        print("ERROR: {} -> {} was accepted".format(text, counts))
+        result = False
+    return result
+
+def max_blends_test():
+    parser = xstitch.argument_parser()
+    if parser.parse_args(["-", "--max-blends", "0"]).max_blends != 0:
+        print("ERROR: --max-blends 0")
+        return False
+    for value in ["-1", "few"]:
+        try:
+            with contextlib.redirect_stderr(io.StringIO()):
+                parser.parse_args(["-", "--max-blends", value])
+        except SystemExit:
+            continue
+        print("ERROR: --max-blends {} was accepted".format(value))
+        return False
+    return True
+
+
+def run_tests(*fs):
+    result = 0
+    for f in fs:
+        print("====", f.__name__, "====")
+        if not f():
+            result = 1
+            print(f.__name__, "failed")
+    sys.exit(result)
+
+def main():
+    run_tests(color_counts_test,
+              max_blends_test)
+
+if __name__ == "__main__":
+    main()